@@ -0,0 +1,39 @@
+"""индексы тем
+
+Revision ID: 5b1e7c2d9a41
+Revises: 20795a560bd4
+Create Date: 2026-10-15 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1e7c2d9a41'
+down_revision: Union[str, None] = '20795a560bd4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Уникальный индекс не создастся, если в таблице уже есть дубли
+    # (группа, тема) — оставляем последнюю запись каждой пары
+    op.execute(
+        "DELETE FROM topics t USING topics d "
+        "WHERE t.group_id = d.group_id "
+        "AND t.telegram_topic_id = d.telegram_topic_id "
+        "AND t.id < d.id"
+    )
+    op.create_index('ix_topics_group_topic', 'topics', ['group_id', 'telegram_topic_id'], unique=True)
+    op.create_index(
+        'ix_topics_group_topic_active', 'topics', ['group_id', 'telegram_topic_id'],
+        unique=False, postgresql_where=sa.text('is_active')
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_topics_group_topic_active', table_name='topics')
+    op.drop_index('ix_topics_group_topic', table_name='topics')
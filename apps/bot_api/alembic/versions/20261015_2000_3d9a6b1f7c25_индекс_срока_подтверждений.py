@@ -0,0 +1,28 @@
+"""индекс срока подтверждений
+
+Revision ID: 3d9a6b1f7c25
+Revises: 5b1e7c2d9a41
+Create Date: 2026-10-15 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3d9a6b1f7c25'
+down_revision: Union[str, None] = '5b1e7c2d9a41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_pending_confirmations_expires_at', 'pending_confirmations', ['expires_at'], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_pending_confirmations_expires_at', table_name='pending_confirmations')
@@ -4,9 +4,10 @@ AI Provider Base Interface
 Единый интерфейс для работы с LLM провайдерами.
 """
 
+import asyncio
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 
 @dataclass
@@ -25,7 +26,7 @@ class RenderedNote:
     tags: list[str]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TopicContext:
     """Topic information for classification/rendering."""
     topic_id: int
@@ -55,6 +56,28 @@ class AIProvider(ABC):
         """
         pass
 
+    async def classify_notes_batch(
+        self,
+        note_texts: list[str],
+        topics: list[TopicContext]
+    ) -> list[ClassificationResult]:
+        """
+        Classify several notes against the same topics.
+        
+        Default implementation issues one classify_note call per note;
+        providers override it to classify the whole batch in one request.
+        
+        Args:
+            note_texts: Texts of the notes to classify
+            topics: List of available topics
+            
+        Returns:
+            ClassificationResult per note, in the same order
+        """
+        return list(await asyncio.gather(
+            *(self.classify_note(text, topics) for text in note_texts)
+        ))
+
     @abstractmethod
     async def render_note(
         self,
@@ -73,6 +96,26 @@ class AIProvider(ABC):
         """
         pass
 
+    async def render_note_stream(
+        self,
+        note_text: str,
+        topic: TopicContext
+    ) -> AsyncIterator[RenderedNote]:
+        """
+        Format a note, yielding progressively more complete versions.
+        
+        Default implementation yields the result of render_note once;
+        providers with streaming APIs yield partial notes as tokens arrive.
+        
+        Args:
+            note_text: Original note text
+            topic: Target topic with formatting rules
+            
+        Yields:
+            Partial notes; the last one is final
+        """
+        yield await self.render_note(note_text, topic)
+
     @abstractmethod
     async def transcribe_voice(self, audio_data: bytes) -> str:
         """
@@ -85,3 +128,22 @@ class AIProvider(ABC):
             Transcribed text
         """
         pass
+
+    async def embed_text(self, text: str) -> Optional[list[float]]:
+        """
+        Get a semantic embedding of the text.
+        
+        Used by the semantic classification cache. Providers without
+        embedding support return None, which disables the cache.
+        
+        Args:
+            text: Text to embed
+            
+        Returns:
+            Embedding vector or None
+        """
+        return None
+
+    async def aclose(self) -> None:
+        """Release provider resources (pooled HTTP connections)."""
+        pass
@@ -0,0 +1,86 @@
+"""
+Batch Classifier
+
+Micro-batching классификации: заметки с одинаковым набором тем, пришедшие
+в течение короткого окна, классифицируются одним запросом к LLM.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .base import AIProvider, ClassificationResult, TopicContext
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = 8
+MAX_WAIT_MS = 100
+
+
+@dataclass
+class _Batch:
+    """Накапливаемая пачка заметок для одного набора тем."""
+    topics: list[TopicContext]
+    items: list[tuple[str, asyncio.Future]] = field(default_factory=list)
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class BatchClassifier:
+    """
+    Накопитель запросов классификации.
+
+    Пачка отправляется, когда набралось max_batch заметок или истекло
+    max_wait_ms с момента первой заметки. Каждый вызывающий ждёт свой Future.
+    """
+
+    def __init__(self, provider: AIProvider, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS):
+        self.provider = provider
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending: dict[tuple, _Batch] = {}
+        self._running: set[asyncio.Task] = set()
+
+    async def submit(self, note_text: str, topics: list[TopicContext]) -> ClassificationResult:
+        """Поставить заметку в очередь и дождаться результата её классификации."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # Пачки разделяются по набору тем: промпт общий для всех заметок пачки
+        key = tuple((t.topic_id, t.title, t.description) for t in topics)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = _Batch(topics=topics)
+            batch.timer = loop.call_later(self.max_wait, self._flush, key)
+            self._pending[key] = batch
+
+        batch.items.append((note_text, future))
+        if len(batch.items) >= self.max_batch:
+            batch.timer.cancel()
+            self._flush(key)
+
+        return await future
+
+    def _flush(self, key: tuple):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        task = asyncio.create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: _Batch):
+        texts = [text for text, _ in batch.items]
+        try:
+            results = await self.provider.classify_notes_batch(texts, batch.topics)
+        except Exception as e:
+            logger.exception("Batch classification failed: %s", e)
+            for _, future in batch.items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logger.debug("Classified batch of %s notes", len(texts))
+        for (_, future), result in zip(batch.items, results):
+            if not future.done():
+                future.set_result(result)
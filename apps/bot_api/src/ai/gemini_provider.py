@@ -4,10 +4,15 @@ Gemini Provider Implementation
 Интеграция с Google Gemini via google-generativeai.
 """
 
-import json
+import asyncio
+import hashlib
 import logging
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+import orjson
 import google.generativeai as genai
+from google.generativeai import caching
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
 from .base import AIProvider, ClassificationResult, RenderedNote, TopicContext
@@ -15,6 +20,30 @@ from src.settings.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Модель эмбеддингов для семантического кэша классификации
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Кэш префикса промпта классификации (каталог тем группы)
+CLASSIFIER_CACHE_TTL = 3600
+CLASSIFIER_CACHE_SIZE = 256
+
+# Варианты достройки обрезанного JSON при потоковом ответе:
+# внутри строки, после значения, внутри списка тегов
+STREAM_JSON_SUFFIXES = ("", "\"}", "}", "\"]}", "]}")
+
+CLASSIFY_TASK = (
+    "Task: Analyze the user's note. Identify ALL topics that might be relevant.\n"
+    "Assign a confidence score (0.0 to 1.0) to each relevant topic.\n\n"
+    "Return JSON only: {\"candidates\": [{\"id\": <topic_id>, \"confidence\": <score>}, ...]}"
+)
+
+CLASSIFY_BATCH_TASK = (
+    "Task: You will receive a JSON list of notes. Analyze EACH note independently. "
+    "Identify ALL topics that might be relevant to it.\n"
+    "Assign a confidence score (0.0 to 1.0) to each relevant topic.\n\n"
+    "Return JSON only: {\"results\": [{\"index\": <note index>, \"candidates\": [{\"id\": <topic_id>, \"confidence\": <score>}, ...]}, ...]}"
+)
+
 
 class GeminiProvider(AIProvider):
     """Google Gemini API implementation."""
@@ -25,7 +54,7 @@ class GeminiProvider(AIProvider):
             logger.warning("GEMINI_API_KEY не задан. AI функции работать не будут.")
             self.model = None
         else:
-            genai.configure(api_key=self.api_key)
+            # SDK держит один клиент на процесс — соединения переиспользуются между вызовами
             genai.configure(api_key=self.api_key)
             # Используем gemini-3-flash-preview по запросу пользователя
             try:
@@ -33,105 +62,172 @@ class GeminiProvider(AIProvider):
             except Exception:
                 # Fallback
                 self.model = genai.GenerativeModel('gemini-flash-latest') 
+        # sha256 каталога тем -> (модель с этим каталогом в префиксе, срок годности)
+        self._classifier_models: OrderedDict[str, tuple[genai.GenerativeModel, float]] = OrderedDict()
 
-    async def classify_note(
-        self,
-        note_text: str,
-        topics: list[TopicContext]
-    ) -> ClassificationResult:
-        """Classify note using Gemini."""
-        if not self.model or not topics:
-            return ClassificationResult(suggested_topic_id=0, top_topics=[], need_new_topic=True)
-
-        topics_str = json.dumps([
+    @staticmethod
+    def _topics_catalog(topics: list[TopicContext]) -> str:
+        """Стабильная часть промпта классификации: правила и каталог тем."""
+        topics_str = orjson.dumps([
             {
                 "id": t.topic_id, 
                 "title": t.title, 
                 "description": t.description
             } 
             for t in topics
-        ], ensure_ascii=False)
+        ]).decode()
 
-        prompt = (
+        return (
             "You are a smart assistant that sorts notes into topics.\n"
             f"Allowed topics: {topics_str}\n\n"
-            "Task: Analyze the user's note. Identify ALL topics that might be relevant.\n"
-            "Assign a confidence score (0.0 to 1.0) to each relevant topic.\n\n"
             "IMPORTANT:\n"
             "1. If the note doesn't match a specific topic, check if there's a 'General', 'Misc', or 'Other' topic (e.g., 'Прочее', 'Все остальное', 'Буфер').\n"
             "2. IF SUCH A GENERAL TOPIC EXISTS, use it instead of returning ID 0.\n"
-            "3. Only return {\"id\": 0, \"confidence\": 1.0} if NO TOPIC is relevant AND NO GENERAL TOPIC is found.\n\n"
-            "Return JSON only: {\"candidates\": [{\"id\": <topic_id>, \"confidence\": <score>}, ...]}"
+            "3. Only return {\"id\": 0, \"confidence\": 1.0} if NO TOPIC is relevant AND NO GENERAL TOPIC is found."
         )
-        
-        # try:
-        # Gemini требует явного указания MIME типа для JSON режима в некоторых версиях,
-        # но простой промпт "Return JSON only" обычно работает.
-        # Для надежности можно использовать generation_config={'response_mime_type': 'application/json'}
-        # если модель поддерживает. gemini-1.5-flash поддерживает.
-        
+
+    async def _classifier_model(self, topics: list[TopicContext]) -> genai.GenerativeModel:
+        """
+        Модель с каталогом тем в system_instruction.
+
+        Каталог — общий префикс всех запросов классификации группы, поэтому он
+        кэшируется на стороне Gemini (CachedContent), а в запросе остаётся только
+        текст заметки. Изменение тем меняет ключ — старая запись вытесняется по LRU.
+        """
+        catalog = self._topics_catalog(topics)
+        key = hashlib.sha256(catalog.encode()).hexdigest()
+
+        cached = self._classifier_models.get(key)
+        if cached and cached[1] > time.monotonic():
+            self._classifier_models.move_to_end(key)
+            return cached[0]
+
+        try:
+            # create — синхронный сетевой вызов SDK
+            content = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=self.model.model_name,
+                system_instruction=catalog,
+                ttl=CLASSIFIER_CACHE_TTL
+            )
+            model = genai.GenerativeModel.from_cached_content(content)
+        except Exception as e:
+            # Кэш недоступен для модели или каталог короче минимального размера —
+            # каталог всё равно уходит префиксом через system_instruction
+            logger.debug("Prompt cache unavailable, using system_instruction: %s", e)
+            model = genai.GenerativeModel(self.model.model_name, system_instruction=catalog)
+
+        # Запись живёт чуть меньше кэша на стороне Gemini
+        self._classifier_models[key] = (model, time.monotonic() + CLASSIFIER_CACHE_TTL - 60)
+        self._classifier_models.move_to_end(key)
+        if len(self._classifier_models) > CLASSIFIER_CACHE_SIZE:
+            self._classifier_models.popitem(last=False)
+        return model
+
+    async def classify_note(
+        self,
+        note_text: str,
+        topics: list[TopicContext]
+    ) -> ClassificationResult:
+        """Classify note using Gemini."""
+        if not self.model or not topics:
+            return ClassificationResult(suggested_topic_id=0, top_topics=[], need_new_topic=True)
+
         try:
             # Gemini требует явного указания MIME типа для JSON режима в некоторых версиях,
             # но простой промпт "Return JSON only" обычно работает.
             # Для надежности можно использовать generation_config={'response_mime_type': 'application/json'}
             # если модель поддерживает. gemini-1.5-flash поддерживает.
-            
-            response = await self.model.generate_content_async(
-                [prompt, note_text],
+            model = await self._classifier_model(topics)
+            response = await model.generate_content_async(
+                [CLASSIFY_TASK, note_text],
                 generation_config={"response_mime_type": "application/json"}
             )
             
-            content = response.text
-            data = json.loads(content)
-            
-            candidates = data.get("candidates", [])
-            if not candidates:
-                 # Fallback logic if structure differs or empty
-                 old_id = data.get("id", 0)
-                 candidates = [{"id": old_id, "confidence": data.get("confidence", 1.0)}]
-
-            # Sort by confidence desc
-            candidates.sort(key=lambda x: x.get("confidence", 0), reverse=True)
-            
-            # Filter invalid topics
-            valid_candidates = [
-                c for c in candidates 
-                if c["id"] == 0 or any(t.topic_id == c["id"] for t in topics)
-            ]
-            
-            if not valid_candidates:
-                valid_candidates = [{"id": 0, "confidence": 1.0}]
-                
-            best = valid_candidates[0]
-            
-            return ClassificationResult(
-                suggested_topic_id=best["id"],
-                top_topics=[{"topic_id": c["id"], "confidence": c.get("confidence", 0.0)} for c in valid_candidates],
-                need_new_topic=(best["id"] == 0)
-            )
+            data = orjson.loads(response.text)
+            return self._parse_classification(data, topics)
 
         except Exception as e:
-            logger.error(f"Error classifying note with Gemini: {e}")
+            logger.error("Error classifying note with Gemini: %s", e)
             return ClassificationResult(suggested_topic_id=0, top_topics=[], need_new_topic=True)
 
         # except Exception as e:
         #     logger.error(f"Error classifying note with Gemini: {e}")
         #     return ClassificationResult(suggested_topic_id=0, top_topics=[], need_new_topic=True)
 
-    async def render_note(
+    @staticmethod
+    def _parse_classification(data: dict, topics: list[TopicContext]) -> ClassificationResult:
+        """Разобрать JSON-ответ классификации в ClassificationResult."""
+        candidates = data.get("candidates", [])
+        if not candidates:
+             # Fallback logic if structure differs or empty
+             old_id = data.get("id", 0)
+             candidates = [{"id": old_id, "confidence": data.get("confidence", 1.0)}]
+
+        # Sort by confidence desc
+        candidates.sort(key=lambda x: x.get("confidence", 0), reverse=True)
+        
+        # Filter invalid topics
+        valid_candidates = [
+            c for c in candidates 
+            if c["id"] == 0 or any(t.topic_id == c["id"] for t in topics)
+        ]
+        
+        if not valid_candidates:
+            valid_candidates = [{"id": 0, "confidence": 1.0}]
+            
+        best = valid_candidates[0]
+        
+        return ClassificationResult(
+            suggested_topic_id=best["id"],
+            top_topics=[{"topic_id": c["id"], "confidence": c.get("confidence", 0.0)} for c in valid_candidates],
+            need_new_topic=(best["id"] == 0)
+        )
+
+    async def classify_notes_batch(
         self,
-        note_text: str,
-        topic: TopicContext
-    ) -> RenderedNote:
-        """Format note using Gemini."""
-        if not self.model:
-             return RenderedNote(title="Заметка", content=note_text, tags=[])
+        note_texts: list[str],
+        topics: list[TopicContext]
+    ) -> list[ClassificationResult]:
+        """Classify several notes with a single Gemini request."""
+        if len(note_texts) == 1:
+            return [await self.classify_note(note_texts[0], topics)]
+
+        empty = [
+            ClassificationResult(suggested_topic_id=0, top_topics=[], need_new_topic=True)
+            for _ in note_texts
+        ]
+        if not self.model or not topics:
+            return empty
+
+        notes_str = orjson.dumps([
+            {"index": i, "text": text}
+            for i, text in enumerate(note_texts)
+        ]).decode()
+
+        try:
+            model = await self._classifier_model(topics)
+            response = await model.generate_content_async(
+                [CLASSIFY_BATCH_TASK, notes_str],
+                generation_config={"response_mime_type": "application/json"}
+            )
+            data = orjson.loads(response.text)
+            by_index = {r.get("index"): r for r in data.get("results", [])}
+            return [
+                self._parse_classification(by_index.get(i, {}), topics)
+                for i in range(len(note_texts))
+            ]
+
+        except Exception as e:
+            logger.error("Error batch classifying notes with Gemini: %s", e)
+            return empty
 
+    @staticmethod
+    def _render_prompt(topic: TopicContext) -> str:
         # Для работы с системой шаблонов нам нужны чистые данные
         # format_rules мы больше не передаем в промпт для стиля, 
         # так как стиль задается шаблоном в боте.
-        
-        prompt = (
+        return (
             "You are a professional editor. Your goal is to extract structured data from the text.\n"
             f"Context (Topic): {topic.title}\n"
             "IMPORTANT: ALWAYS use Russian language for the title, content, and tags.\n"
@@ -143,36 +239,87 @@ class GeminiProvider(AIProvider):
             "Return JSON only: {\"title\": \"...\", \"content\": \"...\", \"tags\": [\"#tag1\", ...]}"
         )
 
-        # try:
+    @staticmethod
+    def _to_rendered_note(data: dict, note_text: str) -> RenderedNote:
+        title = data.get("title", "Заметка")
+        formatted_content = data.get("content", note_text)
+        tags = data.get("tags", [])
+        
+        # Ensure tags start with #
+        formatted_tags = [t if t.startswith('#') else f"#{t}" for t in tags]
+        
+        return RenderedNote(
+            title=title,
+            content=formatted_content,
+            tags=formatted_tags
+        )
+
+    @staticmethod
+    def _parse_partial(buffer: str) -> Optional[dict]:
+        """Разобрать незавершённый JSON ответа, достроив закрывающие символы."""
+        for suffix in STREAM_JSON_SUFFIXES:
+            try:
+                data = orjson.loads(buffer + suffix)
+            except ValueError:
+                continue
+            if isinstance(data, dict):
+                return data
+        return None
+
+    async def render_note(
+        self,
+        note_text: str,
+        topic: TopicContext
+    ) -> RenderedNote:
+        """Format note using Gemini."""
+        if not self.model:
+             return RenderedNote(title="Заметка", content=note_text, tags=[])
+
         try:
             response = await self.model.generate_content_async(
-                [prompt, note_text],
+                [self._render_prompt(topic), note_text],
                 generation_config={"response_mime_type": "application/json"}
             )
             
-            content = response.text
-            data = json.loads(content)
-            
-            title = data.get("title", "Заметка")
-            formatted_content = data.get("content", note_text)
-            tags = data.get("tags", [])
-            
-            # Ensure tags start with #
-            formatted_tags = [t if t.startswith('#') else f"#{t}" for t in tags]
-            
-            return RenderedNote(
-                title=title,
-                content=formatted_content,
-                tags=formatted_tags
-            )
+            data = orjson.loads(response.text)
+            return self._to_rendered_note(data, note_text)
 
         except Exception as e:
-            logger.error(f"Error rendering note with Gemini: {e}")
+            logger.error("Error rendering note with Gemini: %s", e)
             return RenderedNote(title="Заметка", content=note_text, tags=[])
 
-        # except Exception as e:
-        #     logger.error(f"Error rendering note with Gemini: {e}")
-        #     return RenderedNote(title="Заметка", content=note_text, tags=[])
+    async def render_note_stream(
+        self,
+        note_text: str,
+        topic: TopicContext
+    ) -> AsyncIterator[RenderedNote]:
+        """Format note using Gemini streaming, yielding partial notes."""
+        if not self.model:
+            yield RenderedNote(title="Заметка", content=note_text, tags=[])
+            return
+
+        buffer = ""
+        try:
+            response = await self.model.generate_content_async(
+                [self._render_prompt(topic), note_text],
+                generation_config={"response_mime_type": "application/json"},
+                stream=True
+            )
+            async for chunk in response:
+                buffer += chunk.text
+                data = self._parse_partial(buffer)
+                # Пока нет заголовка, показывать нечего
+                if data and data.get("title"):
+                    yield self._to_rendered_note({"content": "", **data}, note_text)
+
+            data = orjson.loads(buffer)
+
+        except Exception as e:
+            logger.error("Error rendering note with Gemini: %s", e)
+            yield RenderedNote(title="Заметка", content=note_text, tags=[])
+            return
+
+        yield self._to_rendered_note(data, note_text)
 
     async def transcribe_voice(self, audio_data: bytes) -> str:
         """Transcribe using Gemini (multimodal)."""
@@ -194,5 +341,21 @@ class GeminiProvider(AIProvider):
             )
             return response.text.strip()
         except Exception as e:
-            logger.error(f"Error transcribing voice: {e}")
+            logger.error("Error transcribing voice: %s", e)
             return ""
+
+    async def embed_text(self, text: str) -> Optional[list[float]]:
+        """Embedding via Gemini embedding endpoint."""
+        if not self.model:
+            return None
+
+        try:
+            result = await genai.embed_content_async(
+                model=EMBEDDING_MODEL,
+                content=text,
+                task_type="semantic_similarity"
+            )
+            return result["embedding"]
+        except Exception as e:
+            logger.error("Error embedding text with Gemini: %s", e)
+            return None
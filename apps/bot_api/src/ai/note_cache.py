@@ -0,0 +1,95 @@
+"""
+Semantic Note Cache
+
+Семантический кэш классификации: почти одинаковые заметки маршрутизируются
+в ту же тему без повторного вызова LLM.
+"""
+
+import math
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Optional
+
+from .base import TopicContext
+
+
+@dataclass
+class _CacheEntry:
+    """Закэшированное решение классификации."""
+    embedding: list[float]  # нормализованный вектор
+    topics_key: int
+    target_topic_id: int
+    created_at: float
+
+
+class SemanticNoteCache:
+    """
+    LRU-кэш решений классификации по группам.
+
+    Поиск — по косинусной близости эмбеддингов заметок; запись считается
+    попаданием, если близость не ниже порога и набор тем группы не менялся.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.85,
+        ttl: float = 3600,
+        max_groups: int = 512,
+        max_entries_per_group: int = 64
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_groups = max_groups
+        self.max_entries_per_group = max_entries_per_group
+        self._groups: OrderedDict[int, deque[_CacheEntry]] = OrderedDict()
+
+    @staticmethod
+    def topics_key(topics: list[TopicContext]) -> int:
+        """Отпечаток набора тем: изменение тем делает старые записи невалидными."""
+        return hash(tuple((t.topic_id, t.title, t.description) for t in topics))
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> list[float]:
+        norm = math.sqrt(sum(x * x for x in embedding))
+        if not norm:
+            return embedding
+        return [x / norm for x in embedding]
+
+    def lookup(self, group_id: int, embedding: list[float], topics_key: int) -> Optional[int]:
+        """Вернуть ID темы для похожей заметки или None."""
+        entries = self._groups.get(group_id)
+        if not entries:
+            return None
+
+        self._groups.move_to_end(group_id)
+        vector = self._normalize(embedding)
+        deadline = time.monotonic() - self.ttl
+
+        best_id, best_sim = None, self.threshold
+        for entry in entries:
+            if entry.created_at < deadline or entry.topics_key != topics_key:
+                continue
+            sim = sum(a * b for a, b in zip(vector, entry.embedding))
+            if sim >= best_sim:
+                best_id, best_sim = entry.target_topic_id, sim
+
+        return best_id
+
+    def store(self, group_id: int, embedding: list[float], topics_key: int, target_topic_id: int) -> None:
+        """Запомнить решение классификации для заметки."""
+        entries = self._groups.get(group_id)
+        if entries is None:
+            entries = deque(maxlen=self.max_entries_per_group)
+            self._groups[group_id] = entries
+            if len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(group_id)
+
+        entries.append(_CacheEntry(
+            embedding=self._normalize(embedding),
+            topics_key=topics_key,
+            target_topic_id=target_topic_id,
+            created_at=time.monotonic()
+        ))
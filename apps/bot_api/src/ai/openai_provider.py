@@ -4,9 +4,10 @@ OpenAI Provider Implementation
 Интеграция с OpenAI API (ChatGPT, Whisper).
 """
 
-import json
 import logging
 from typing import Optional
+import httpx
+import orjson
 from openai import AsyncOpenAI
 
 from .base import AIProvider, ClassificationResult, RenderedNote, TopicContext
@@ -24,7 +25,16 @@ class OpenAIProvider(AIProvider):
             logger.warning("OPENAI_API_KEY не задан. AI функции работать не будут.")
             self.client = None
         else:
-            self.client = AsyncOpenAI(api_key=self.api_key)
+            # Один HTTP-клиент на провайдер: keep-alive соединения переиспользуются
+            # между вызовами, TLS-рукопожатие не повторяется на каждый запрос
+            self.client = AsyncOpenAI(
+                api_key=self.api_key,
+                http_client=httpx.AsyncClient(
+                    http2=True,
+                    timeout=30,
+                    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128)
+                )
+            )
 
     async def classify_note(
         self,
@@ -35,14 +45,14 @@ class OpenAIProvider(AIProvider):
         if not self.client or not topics:
             return ClassificationResult(suggested_topic_id=0, top_topics=[], need_new_topic=True)
 
-        topics_str = json.dumps([
+        topics_str = orjson.dumps([
             {
                 "id": t.topic_id, 
                 "title": t.title, 
                 "description": t.description
             } 
             for t in topics
-        ], ensure_ascii=False)
+        ]).decode()
 
         prompt = (
             "You are a smart assistant that sorts notes into topics.\n"
@@ -65,7 +75,7 @@ class OpenAIProvider(AIProvider):
             )
             
             content = response.choices[0].message.content
-            data = json.loads(content)
+            data = orjson.loads(content)
             
             topic_id = data.get("id", 0)
             
@@ -80,7 +90,7 @@ class OpenAIProvider(AIProvider):
             )
 
         except Exception as e:
-            logger.error(f"Error classifying note: {e}")
+            logger.error("Error classifying note: %s", e)
             return ClassificationResult(suggested_topic_id=0, top_topics=[], need_new_topic=True)
 
     async def render_note(
@@ -118,7 +128,7 @@ class OpenAIProvider(AIProvider):
             )
             
             content = response.choices[0].message.content
-            data = json.loads(content)
+            data = orjson.loads(content)
             
             title = data.get("title", "Заметка")
             formatted_content = data.get("content", note_text)
@@ -134,10 +144,30 @@ class OpenAIProvider(AIProvider):
             )
 
         except Exception as e:
-            logger.error(f"Error rendering note: {e}")
+            logger.error("Error rendering note: %s", e)
             return RenderedNote(title="Заметка", content=note_text, tags=[])
 
     async def transcribe_voice(self, audio_data: bytes) -> str:
         """Transcribe using Whisper API."""
         # TODO: Implement Whisper API call later
         return ""
+
+    async def embed_text(self, text: str) -> Optional[list[float]]:
+        """Embedding via OpenAI embeddings API."""
+        if not self.client:
+            return None
+
+        try:
+            response = await self.client.embeddings.create(
+                model="text-embedding-3-small",
+                input=text
+            )
+            return response.data[0].embedding
+        except Exception as e:
+            logger.error("Error embedding text: %s", e)
+            return None
+
+    async def aclose(self) -> None:
+        """Close the pooled HTTP client."""
+        if self.client:
+            await self.client.close()
@@ -21,7 +21,7 @@ from aiogram.fsm.context import FSMContext
 
 from src.db.database import get_async_session_maker
 from src.db.models import Topic
-from src.services import db_service
+from src.services import cache, db_service
 from src.bot.states import TopicInitState, TopicRulesState, TopicFormatState
 from src.bot.keyboards import (
     get_topic_settings_keyboard, 
@@ -129,6 +129,7 @@ async def process_init_description(message: Message, state: FSMContext):
             topic.description = description
             topic.title = description[:50] + ("..." if len(description) > 50 else "")
             await session.commit()
+            await cache.delete(cache.topics_key(group_id))
             logger.info(f"[INIT] Тема {topic_id} настроена: {description[:50]}...")
     
     await state.clear()
@@ -241,6 +242,7 @@ async def _save_topic_rules(message: Message, topic_id: int, rules_text: str, bo
         topic.description = rules_text
         topic.title = rules_text[:50] + ("..." if len(rules_text) > 50 else "")
         await session.commit()
+        await cache.delete(cache.topics_key(group.id))
         
         logger.info(f"[RULES] Тема {topic_id}: {rules_text[:50]}...")
         
@@ -405,6 +407,7 @@ async def _save_topic_format(message: Message, topic_id: int, format_text: str,
         
         topic.format_policy_text = format_text
         await session.commit()
+        await cache.delete(cache.topics_key(group.id))
         
         display_format = format_text or DEFAULT_FORMAT
         logger.info(f"[FORMAT] Тема {topic_id}: {display_format[:50]}...")
@@ -1,9 +1,13 @@
 import logging
+import re
 from datetime import datetime
+from typing import Awaitable, Callable
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InputMediaPhoto
-from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.exceptions import TelegramRetryAfter
+from markupsafe import escape
 
 from src.db.database import get_async_session_maker
 from src.db.models import Group, Topic
@@ -17,49 +21,63 @@ from src.bot.keyboards import get_settings_keyboard, get_bind_topic_keyboard, ge
 from src.settings.config import settings
 from src.ai.openai_provider import OpenAIProvider, TopicContext
 from src.ai.gemini_provider import GeminiProvider
+from src.ai.note_cache import SemanticNoteCache
+from src.ai.batch_classifier import BatchClassifier
 from src.bot.constants import DEFAULT_FORMAT
+from src.bot.group_commands import delete_message_safe
 
 logger = logging.getLogger(__name__)
 
+# Заготовка заметки в целевой теме и минимальный интервал её правок при генерации
+NOTE_PLACEHOLDER = "⏳ …"
+STREAM_EDIT_INTERVAL = 0.4
+
 router = Router()
 # ai_provider = OpenAIProvider()
 ai_provider = GeminiProvider()
+# Кэш решений классификации для почти одинаковых заметок
+note_cache = SemanticNoteCache()
+# Объединение одновременных запросов классификации в один вызов LLM
+batch_classifier = BatchClassifier(ai_provider)
+
+
+# Плейсхолдер шаблона: [title], [caption], [user_id] и т.п.
+_PLACEHOLDER_RE = re.compile(r"\[(\w+)\]")
 
 
 def format_note_content(template: str, rendered_note, original_text: str, metadata: dict = None) -> str:
     """
     Форматирует заметку по шаблону.
     Поддерживает: [title], [caption], [message], [tags], [date] и метаданные.
+    Значения экранируются для parse_mode=HTML — разметку задаёт только шаблон.
     """
     if not template:
         template = DEFAULT_FORMAT
     
     # Базовые переменные
     replacements = {
-        "[title]": rendered_note.title or "",
-        "[caption]": rendered_note.content or "", # Content now acts as 'Caption'
-        "[message]": original_text,
-        "[tags]": " ".join(rendered_note.tags) if rendered_note.tags else "",
-        "[date]": datetime.now().strftime("%d.%m.%Y %H:%M"),
+        "title": rendered_note.title or "",
+        "caption": rendered_note.content or "", # Content now acts as 'Caption'
+        "message": original_text,
+        "tags": " ".join(rendered_note.tags) if rendered_note.tags else "",
+        "date": datetime.now().strftime("%d.%m.%Y %H:%M"),
         # Legacy aliases support if any
-        "[content]": rendered_note.content or "",
+        "content": rendered_note.content or "",
     }
     
     # Метаданные (например, инфо о юзере)
     if metadata:
         for k, v in metadata.items():
-            replacements[f"[{k}]"] = str(v)
+            replacements[k] = str(v)
 
-    result = template
-    for k, v in replacements.items():
-        result = result.replace(k, v)
-        
-    return result
+    # Один проход по шаблону: подставленный текст повторно не сканируется,
+    # неизвестные плейсхолдеры остаются как есть
+    escaped = {k: str(escape(v)) for k, v in replacements.items()}
+    return _PLACEHOLDER_RE.sub(lambda m: escaped.get(m.group(1), m.group(0)), template)
 
 
 # ============ Private Chat Handlers ============
 
-@router.message(Command("start"), F.chat.type == "private")
 async def cmd_start_private(message: Message):
     """Command /start in private chat."""
     user_name = message.from_user.first_name
@@ -70,7 +88,6 @@ async def cmd_start_private(message: Message):
     )
 
 
-@router.message(Command("settings"), F.chat.type == "private")
 async def cmd_settings(message: Message):
     """Open settings Mini App."""
     if not settings.TELEGRAM_WEBHOOK_URL:
@@ -84,20 +101,34 @@ async def cmd_settings(message: Message):
     )
 
 
-# ============ Group Chat Handlers ============
+# Таблица диспетчеризации команд: (тип чата, команда) -> обработчик.
+# Один поиск в dict вместо последовательной проверки фильтров каждого хендлера.
+_COMMAND_DISPATCH: dict[tuple[str, str], Callable[[Message], Awaitable[None]]] = {
+    ("private", "start"): cmd_start_private,
+    ("private", "settings"): cmd_settings,
+}
 
-def is_group_forum(message: Message) -> bool:
-    """
-    Проверяет, является ли чат супергруппой (форумом).
-    
-    Для обработки General топика, message_thread_id может быть None.
-    Но сам чат должен быть форумом.
-    """
-    return (
-        message.chat.type in ("group", "supergroup") and
-        getattr(message.chat, 'is_forum', False)
-    )
 
+def _parse_command(message: Message) -> tuple[str, str]:
+    """Имя команды без '/' (в нижнем регистре) и упомянутый @username бота ('' если нет)."""
+    command, _, mention = message.text.split(maxsplit=1)[0][1:].partition("@")
+    return command.lower(), mention
+
+
+@router.message(F.text.startswith("/"))
+async def command_dispatcher(message: Message, bot: Bot):
+    """Быстрый путь для команд; при промахе передаёт апдейт дальше по цепочке фильтров."""
+    command, mention = _parse_command(message)
+    handler = _COMMAND_DISPATCH.get((message.chat.type, command))
+    if handler is None:
+        raise SkipHandler()
+    # /start@OtherBot в группе адресован другому боту
+    if mention and mention.lower() != (await bot.me()).username.lower():
+        return
+    await handler(message)
+
+
+# ============ Group Chat Handlers ============
 
 async def _process_group_message(message: Message):
     """
@@ -106,10 +137,9 @@ async def _process_group_message(message: Message):
     Логика:
     1. Если это General (thread_id=None) -> AI Маршрутизация
     2. Если это Топик (thread_id != None) -> Просто сохраняем/обрабатываем как заметку в этот топик
-    """
-    if not is_group_forum(message):
-        return
 
+    Тип чата и признак форума проверяются фильтрами хендлеров.
+    """
     user_id = message.from_user.id
     chat_id = message.chat.id
     topic_id = message.message_thread_id
@@ -150,7 +180,7 @@ async def _process_group_message(message: Message):
             # text = f"[Голосовое] {text}"
             
         except Exception as e:
-            logger.error(f"Voice processing error: {e}")
+            logger.error("Voice processing error: %s", e)
             try:
                 await processing_msg.edit_text("⚠️ Ошибка обработки голосового.")
             except:
@@ -174,39 +204,30 @@ async def _process_group_message(message: Message):
 
     session_maker = get_async_session_maker()
     async with session_maker() as session:
-        # Получаем/создаем пользователя и группу
-        user = await db_service.get_or_create_user(session, user_id)
-        group = await db_service.get_or_create_group(session, user.id, chat_id, message.chat.title, is_forum=True)
-        
-        # Получаем список активных тем (нужен везде)
-        topics = await db_service.get_group_topics(session, group.id)
+        # Пользователь, группа и активные темы (нужны везде) — одним обращением к БД
+        user, group, topics = await db_service.load_context(
+            session, user_id, chat_id, message.chat.title, is_forum=True
+        )
+        # Индекс тем по telegram id — строится один раз на сообщение
+        topics_by_tid = {t.telegram_topic_id: t for t in topics}
 
         # Helper для отправки (Refactored)
-        async def _process_and_send_note(note_text: str, target_t_id: int):
-            target_topic = next((t for t in topics if t.telegram_topic_id == target_t_id), None)
+        async def _process_and_send_note(note_text: str, target_t_id: int, delete_source: bool = False) -> bool:
+            """
+            Отформатировать и отправить заметку. Возвращает True при успешной отправке.
+            При delete_source исходное сообщение удаляется параллельно с уведомлением.
+            """
+            target_topic = topics_by_tid.get(target_t_id)
             if not target_topic:
-                 logger.error(f"Topic {target_t_id} not found in active topics")
-                 return
-
-            try:
-                rendered_note = await ai_provider.render_note(
-                    note_text, 
-                    TopicContext(
-                        topic_id=target_topic.telegram_topic_id,
-                        title=target_topic.title,
-                        description=target_topic.description,
-                        format_policy_text=target_topic.format_policy_text
-                    )
-                )
-            except Exception as e:
-                logger.error(f"Rendering failed: {e}")
-
-                err_msg = await message.answer(
-                    f"⚠️ <b>Ошибка AI (форматирование):</b>\n{str(e)}",
-                    reply_markup=get_close_keyboard()
-                )
-                asyncio.create_task(delete_later(err_msg))
-                return
+                 logger.error("Topic %s not found in active topics", target_t_id)
+                 return False
+
+            topic_ctx = TopicContext(
+                topic_id=target_topic.telegram_topic_id,
+                title=target_topic.title,
+                description=target_topic.description,
+                format_policy_text=target_topic.format_policy_text
+            )
 
             # Формируем метаданные для шаблона
             metadata = {
@@ -224,7 +245,47 @@ async def _process_group_message(message: Message):
                 "url": f"https://t.me/c/{str(chat_id)[4:] if str(chat_id).startswith('-100') else chat_id}/{message.message_id}"
             }
 
-            # Применяем шаблон
+            async def _send_error(text: str):
+                err_msg = await message.answer(text, reply_markup=get_close_keyboard())
+                asyncio.create_task(delete_later(err_msg))
+
+            # Сразу публикуем заготовку в целевой теме и дописываем её по мере генерации
+            try:
+                note_msg = await message.bot.send_message(
+                    chat_id=chat_id,
+                    message_thread_id=target_t_id,
+                    text=NOTE_PLACEHOLDER
+                )
+            except Exception as e:
+                logger.error("Ошибка при перемещении заметки: %s", e)
+                await _send_error(f"⚠️ <b>Ошибка отправки:</b>\n{str(e)}")
+                return False
+
+            shown_text = NOTE_PLACEHOLDER
+            try:
+                loop = asyncio.get_running_loop()
+                next_edit_at = loop.time()
+                async for rendered_note in ai_provider.render_note_stream(note_text, topic_ctx):
+                    if loop.time() < next_edit_at:
+                        continue
+                    partial_text = format_note_content(
+                        target_topic.format_policy_text, rendered_note, note_text, metadata
+                    )
+                    if partial_text != shown_text:
+                        # Промежуточные правки не критичны (лимиты Telegram и т.п.)
+                        try:
+                            await note_msg.edit_text(partial_text, parse_mode="HTML")
+                            shown_text = partial_text
+                        except Exception as e:
+                            logger.debug("Промежуточная правка заметки пропущена: %s", e)
+                    next_edit_at = loop.time() + STREAM_EDIT_INTERVAL
+            except Exception as e:
+                logger.error("Rendering failed: %s", e)
+                await delete_message_safe(note_msg)
+                await _send_error(f"⚠️ <b>Ошибка AI (форматирование):</b>\n{str(e)}")
+                return False
+
+            # Применяем шаблон к итоговой заметке
             note_content = format_note_content(
                 target_topic.format_policy_text, 
                 rendered_note, 
@@ -232,29 +293,33 @@ async def _process_group_message(message: Message):
                 metadata
             )
 
-            # Отправляем в целевую тему
             try:
-                await message.bot.send_message(
-                    chat_id=chat_id,
-                    message_thread_id=target_t_id,
-                    text=note_content,
-                    parse_mode="HTML"
-                )
-                logger.info(f"Сообщение перемещено в тему {target_t_id}")
+                if note_content != shown_text:
+                    try:
+                        await note_msg.edit_text(note_content, parse_mode="HTML")
+                    except TelegramRetryAfter as e:
+                        await asyncio.sleep(e.retry_after)
+                        await note_msg.edit_text(note_content, parse_mode="HTML")
+                logger.debug("Сообщение перемещено в тему %s", target_t_id)
                 
-                status_msg = await message.answer(
-                    f"🚀 Заметка отправлена в тему <b>{target_topic.title}</b>",
-                    reply_markup=get_close_keyboard()
+                # Уведомление и удаление исходника независимы — выполняем параллельно
+                status_msg, _ = await asyncio.gather(
+                    message.answer(
+                        f"🚀 Заметка отправлена в тему <b>{target_topic.title}</b>",
+                        reply_markup=get_close_keyboard()
+                    ),
+                    delete_message_safe(message) if delete_source else asyncio.sleep(0),
+                    return_exceptions=True
                 )
-                asyncio.create_task(delete_later(status_msg))
+                if isinstance(status_msg, Message):
+                    asyncio.create_task(delete_later(status_msg))
+                return True
                 
             except Exception as e:
-                logger.error(f"Ошибка при перемещении заметки: {e}")
-                err_msg = await message.answer(
-                    f"⚠️ <b>Ошибка отправки:</b>\n{str(e)}",
-                    reply_markup=get_close_keyboard()
-                )
-                asyncio.create_task(delete_later(err_msg))
+                logger.error("Ошибка при перемещении заметки: %s", e)
+                await delete_message_safe(note_msg)
+                await _send_error(f"⚠️ <b>Ошибка отправки:</b>\n{str(e)}")
+                return False
 
 
         # Сценарий 1: Сообщение в General (Буфер) => Маршрутизация
@@ -263,23 +328,36 @@ async def _process_group_message(message: Message):
             
             if not topics:
                 # Нет тем для сортировки — ничего не делаем или просим создать
-                logger.info("No active topics found for sorting. Ignoring message in General.")
+                logger.debug("No active topics found for sorting. Ignoring message in General.")
                 return
 
             # Подготавливаем контекст для AI
             ai_topics = [
                 TopicContext(
-                    topic_id=t.telegram_topic_id,
+                    topic_id=tid,
                     title=t.title,
                     description=t.description
-                ) for t in topics
+                ) for tid, t in topics_by_tid.items()
             ]
+
+            # Семантический кэш: почти одинаковые заметки идут в ту же тему без LLM
+            topics_key = SemanticNoteCache.topics_key(ai_topics)
+            embedding = await ai_provider.embed_text(text)
+            cached_topic_id = (
+                note_cache.lookup(group.id, embedding, topics_key) if embedding else None
+            )
+            if cached_topic_id is not None:
+                logger.debug("Semantic cache hit: topic %s", cached_topic_id)
+                sent = await _process_and_send_note(text, cached_topic_id, delete_source=True)
+                if not sent:
+                    await delete_message_safe(message)
+                return
             
             # Классификация
             try:
-                classification = await ai_provider.classify_note(text, ai_topics)
+                classification = await batch_classifier.submit(text, ai_topics)
             except Exception as e:
-                logger.error(f"Classification failed: {e}")
+                logger.error("Classification failed: %s", e)
 
                 err_msg = await message.answer(
                     f"⚠️ <b>Ошибка AI (классификация):</b>\n{str(e)}",
@@ -303,7 +381,7 @@ async def _process_group_message(message: Message):
                     None
                 )
                 if fallback_topic:
-                    logger.info(f"Fallback matched topic: {fallback_topic.telegram_topic_id} ({fallback_topic.title})")
+                    logger.debug("Fallback matched topic: %s (%s)", fallback_topic.telegram_topic_id, fallback_topic.title)
                     target_topic_id = fallback_topic.telegram_topic_id
                     valid_candidates = [{'topic_id': target_topic_id, 'confidence': 1.0}]
                     # Сбрасываем неоднозначность для фоллбэка
@@ -313,7 +391,7 @@ async def _process_group_message(message: Message):
             else:
                 is_ambiguous = len(valid_candidates) > 1
 
-            logger.info(f"Target: {target_topic_id}, Ambiguous: {is_ambiguous}, Candidates: {valid_candidates}")
+            logger.debug("Target: %s, Ambiguous: %s, Candidates: %s", target_topic_id, is_ambiguous, valid_candidates)
             
             if is_ambiguous:
                 # Сохраняем "Ожидание подтверждения" в БД
@@ -348,16 +426,15 @@ async def _process_group_message(message: Message):
                 # Отправляем сообщение с кнопками
                 kb = get_ambiguity_keyboard(conf_id, candidate_topics_info)
 
-                msg = await message.answer(
-                    "🤔 Не уверен, куда сохранить эту заметку.\nВыберите подходящую тему:",
-                    reply_markup=kb
+                # Вопрос и удаление исходного сообщения (чистый буфер) — параллельно
+                await asyncio.gather(
+                    message.answer(
+                        "🤔 Не уверен, куда сохранить эту заметку.\nВыберите подходящую тему:",
+                        reply_markup=kb
+                    ),
+                    delete_message_safe(message),
+                    return_exceptions=True
                 )
-                
-                # Удаляем исходное сообщение (чистый буфер)
-                try:
-                    await message.delete()
-                except Exception:
-                    pass
                 return
 
 
@@ -365,20 +442,20 @@ async def _process_group_message(message: Message):
                 err_msg = await message.answer(
                     f"⚠️ <b>Не удалось определить тему</b>\n\n"
                     f"AI не нашел подходящей темы для: <i>{text[:50]}...</i>\n"
-                    f"Активные темы: {', '.join([t.title for t in topics])}",
+                    f"Активные темы: {', '.join(t.title for t in topics)}",
                     reply_markup=get_close_keyboard()
                 )
                 asyncio.create_task(delete_later(err_msg))
                 return
 
             # Нашли (одну) тему! 
-            await _process_and_send_note(text, target_topic_id)
+            sent = await _process_and_send_note(text, target_topic_id, delete_source=True)
+            if sent and embedding:
+                note_cache.store(group.id, embedding, topics_key, target_topic_id)
             
-            # Удаляем из General (мы это делали в конце, теперь тут)
-            try:
-                await message.delete()
-            except Exception:
-                pass
+            # Удаляем из General (при успехе это уже сделано вместе с уведомлением)
+            if not sent:
+                await delete_message_safe(message)
             
             return
 
@@ -402,7 +479,7 @@ async def _process_group_message(message: Message):
 
         # Если тема есть и активна — тут можно было бы тоже форматировать,
         # но пока оставим как есть (просто логирование или сохранение)
-        logger.info(f"Сообщение в теме {topic_id}: {text[:20]}...")
+        logger.debug("Сообщение в теме %s: %.20s...", topic_id, text)
 
 
 @router.callback_query(F.data.startswith("confirm_topic:"))
@@ -439,7 +516,7 @@ async def cb_confirm_topic(callback: CallbackQuery):
             await callback.answer("❌ Группа не найдена")
             return
             
-        topics = await db_service.get_group_topics(session, group.id)
+        topics = await db_service.get_group_topic_rows(session, group.id)
 
         target_ids = []
         if choisen_id_str == "all":
@@ -464,8 +541,9 @@ async def cb_confirm_topic(callback: CallbackQuery):
             except Exception:
                 pass
 
+        topics_by_tid = {t.telegram_topic_id: t for t in topics}
         for target_t_id in target_ids:
-            target_topic = next((t for t in topics if t.telegram_topic_id == target_t_id), None)
+            target_topic = topics_by_tid.get(target_t_id)
             if not target_topic:
                  continue
                  
@@ -514,7 +592,7 @@ async def cb_confirm_topic(callback: CallbackQuery):
                 asyncio.create_task(delete_later(status_msg))
                 
             except Exception as e:
-                logger.error(f"Error processing note for topic {target_t_id}: {e}")
+                logger.error("Error processing note for topic %s: %s", target_t_id, e)
                 err_msg = await callback.message.answer(
                     f"⚠️ Ошибка для темы {target_topic.title}:\n{e}",
                     reply_markup=get_close_keyboard()
@@ -522,7 +600,58 @@ async def cb_confirm_topic(callback: CallbackQuery):
                 asyncio.create_task(delete_later(err_msg))
 
 
-@router.message(F.chat.type.in_({"group", "supergroup"}))
-async def group_message_handler(message: Message):
-    """Handler for all group messages."""
-    await _process_group_message(message)
+# Фоновая обработка групповых сообщений: хендлер сразу отдаёт управление
+# диспетчеру (и webhook сразу отвечает 200), а число сообщений в работе ограничено.
+# Лимит выводится из размера пула БД этого процесса: каждой задаче нужно
+# соединение, и db_pool_reserve соединений остаётся WebApp и очистке
+_background_limit = asyncio.Semaphore(max(
+    1, settings.db_pool_size + settings.db_max_overflow - settings.db_pool_reserve
+))
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _process_group_message_limited(message: Message):
+    async with _background_limit:
+        await _process_group_message(message)
+
+
+def _on_background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Ошибка фоновой обработки сообщения", exc_info=task.exception())
+
+
+async def drain_background_tasks():
+    """Дождаться завершения фоновых задач (при остановке приложения)."""
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
+def _schedule_group_message(message: Message):
+    task = asyncio.create_task(_process_group_message_limited(message))
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+
+
+# Фильтры проверяются диспетчером до вызова хендлера: сообщения не из форума
+# и команды (в том числе в подписи к медиа) не порождают фоновых задач
+_IN_FORUM = (
+    F.chat.type.in_({"group", "supergroup"}),
+    F.chat.is_forum,
+    ~F.text.startswith("/"),
+    ~F.caption.startswith("/"),
+)
+# Тема 1 - это General в некоторых клиентах/API версиях, либо None
+_IN_GENERAL = F.message_thread_id.in_({None, 1})
+
+
+@router.message(*_IN_FORUM, _IN_GENERAL)
+async def general_message_handler(message: Message):
+    """Сообщение в General: AI-маршрутизация в темы."""
+    _schedule_group_message(message)
+
+
+@router.message(*_IN_FORUM, ~_IN_GENERAL)
+async def topic_message_handler(message: Message):
+    """Сообщение в теме: заметка для этой темы."""
+    _schedule_group_message(message)
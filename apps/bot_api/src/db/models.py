@@ -7,7 +7,7 @@ SQLAlchemy модели для хранения метаданных.
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, String, Text, func
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Index, Integer, String, Text, func, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .database import Base
@@ -45,6 +45,15 @@ class Group(Base):
 class Topic(Base):
     """Telegram forum topic within a group."""
     __tablename__ = "topics"
+    __table_args__ = (
+        # Поиск темы по (группа, telegram id) — пара уникальна в рамках группы
+        Index("ix_topics_group_topic", "group_id", "telegram_topic_id", unique=True),
+        # Активные темы группы (частичный индекс: неактивные темы в него не входят)
+        Index(
+            "ix_topics_group_topic_active", "group_id", "telegram_topic_id",
+            postgresql_where=text("is_active")
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     telegram_topic_id: Mapped[int] = mapped_column(BigInteger, index=True)
@@ -77,6 +86,10 @@ class AISettings(Base):
 class PendingConfirmation(Base):
     """Temporary storage for pending note confirmations."""
     __tablename__ = "pending_confirmations"
+    __table_args__ = (
+        # Периодическая очистка удаляет просроченные записи одним DELETE по диапазону
+        Index("ix_pending_confirmations_expires_at", "expires_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
@@ -5,25 +5,53 @@ Telegram Bot «Личный секретарь» - Main Entry Point
 """
 
 import asyncio
+import hashlib
+import hmac
 import logging
+import logging.handlers
+import queue
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.types import Update
 
 from src.settings.config import settings
-from src.bot.handlers import router as bot_router
+from src.bot.handlers import router as bot_router, drain_background_tasks, ai_provider
 from src.bot.group_commands import group_router, setup_bot_commands
 from src.webapp.api import router as webapp_router
-from src.db.database import init_db, get_async_session_maker
+from src.db.database import init_db, warm_up_pool, get_async_session_maker
+from src.services.cache import close_redis
+from src.services.db_service import delete_expired_confirmations
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Настроить логирование.
+
+    Обработчики пишут записи в очередь, вывод выполняет QueueListener в своём
+    потоке — запись лога не блокирует event loop на I/O.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Итоговый формат применяет handler слушателя
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=settings.LOG_LEVEL, handlers=[queue_handler])
+    # aiogram пишет строку INFO на каждый апдейт
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -36,6 +64,29 @@ dp = Dispatcher()
 dp.include_router(group_router)  # Групповые команды (первый приоритет)
 dp.include_router(bot_router)     # Остальные обработчики
 
+# Секрет webhook: часть URL и заголовок X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = settings.WEBHOOK_SECRET or hashlib.sha256(
+    settings.TELEGRAM_BOT_TOKEN.encode()
+).hexdigest()
+WEBHOOK_PATH = f"/tg/{WEBHOOK_SECRET}"
+
+# Период очистки просроченных подтверждений (сек)
+EXPIRE_INTERVAL = 60
+
+
+async def _expire_loop():
+    """Периодически удалять просроченные подтверждения одним DELETE."""
+    session_maker = get_async_session_maker()
+    while True:
+        try:
+            async with session_maker() as session:
+                deleted = await delete_expired_confirmations(session)
+            if deleted:
+                logger.debug("Удалено просроченных подтверждений: %s", deleted)
+        except Exception as e:
+            logger.exception("Ошибка очистки подтверждений: %s", e)
+        await asyncio.sleep(EXPIRE_INTERVAL)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -43,27 +94,49 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Запуск приложения...")
     await init_db()
+    await warm_up_pool()
+
+    # Настраиваем меню команд
+    await setup_bot_commands(bot)
+    expire_task = asyncio.create_task(_expire_loop())
     
     # Запуск polling в фоне (для разработки)
-    # В production используется webhook
+    # В production используется webhook: Telegram сам присылает апдейты
     if settings.USE_POLLING:
-        # Настраиваем меню команд
-        await setup_bot_commands(bot)
-        
+        # getUpdates не работает, пока у токена зарегистрирован webhook
+        await bot.delete_webhook(drop_pending_updates=False)
         polling_task = asyncio.create_task(dp.start_polling(bot))
         logger.info("Бот запущен в режиме polling")
+    elif settings.TELEGRAM_WEBHOOK_URL:
+        # Процессов uvicorn может быть несколько: webhook регистрируется, только
+        # если ещё не указывает сюда, и накопленные апдейты не сбрасываются
+        webhook_url = f"{settings.TELEGRAM_WEBHOOK_URL}{WEBHOOK_PATH}"
+        webhook_info = await bot.get_webhook_info()
+        if webhook_info.url != webhook_url:
+            await bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET)
+        logger.info("Бот запущен в режиме webhook")
+    else:
+        logger.error("USE_POLLING=false, но TELEGRAM_WEBHOOK_URL не задан — бот не получает апдейты")
     
     yield
     
     # Shutdown
     logger.info("Остановка приложения...")
+    expire_task.cancel()
     if settings.USE_POLLING:
         polling_task.cancel()
         try:
             await polling_task
         except asyncio.CancelledError:
             pass
+    # Webhook при остановке не снимается: перезапуск одного процесса
+    # не должен отключать приём апдейтов у остальных
+    # Не теряем уже принятые сообщения
+    await drain_background_tasks()
+    await ai_provider.aclose()
+    await close_redis()
     await bot.session.close()
+    log_listener.stop()
 
 
 # FastAPI app
@@ -71,7 +144,8 @@ app = FastAPI(
     title="Личный секретарь API",
     description="API для Telegram-бота и WebApp",
     version="0.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS для WebApp (если нужен доступ с других доменов)
@@ -106,6 +180,21 @@ async def redirect_to_webapp():
     return RedirectResponse(url="/static/webapp/index.html")
 
 
+@app.post("/tg/{secret}", include_in_schema=False)
+async def telegram_webhook(secret: str, request: Request):
+    """Приём апдейтов Telegram в режиме webhook."""
+    header_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not (
+        hmac.compare_digest(secret, WEBHOOK_SECRET)
+        and hmac.compare_digest(header_secret, WEBHOOK_SECRET)
+    ):
+        raise HTTPException(status_code=403, detail="Invalid webhook secret")
+
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    await dp.feed_update(bot, update)
+    return Response()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -114,5 +203,14 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # USE_POLLING вместе с WORKERS > 1 отклоняется при загрузке настроек
+    uvicorn.run(
+        "src.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=settings.WORKERS
+    )
 
@@ -0,0 +1,125 @@
+"""
+Cache Service
+
+Кэш горячих данных обработки сообщений: пользователь, группа, темы группы.
+
+Два уровня: L0 — в памяти процесса (несколько секунд, гасит всплески
+сообщений без обращения к Redis), L1 — Redis (минуты, общий для процессов).
+Ошибки Redis не прерывают обработку: данные читаются из БД, а L1 отключается
+на L1_BACKOFF секунд, чтобы недоступный Redis не добавлял таймауты к каждому
+сообщению.
+"""
+
+import logging
+import time
+from typing import Any, Optional
+
+import orjson
+from cachetools import TTLCache
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from src.settings.config import settings
+
+logger = logging.getLogger(__name__)
+
+L0_TTL = 5
+L0_MAX_SIZE = 4096
+L1_TTL = 300
+L1_BACKOFF = 30
+
+_local: TTLCache = TTLCache(maxsize=L0_MAX_SIZE, ttl=L0_TTL)
+_redis: Optional[aioredis.Redis] = None
+# До этого момента (time.monotonic) обращения к Redis пропускаются
+_l1_disabled_until = 0.0
+
+
+def user_key(telegram_user_id: int) -> str:
+    return f"user:{telegram_user_id}"
+
+
+def group_key(chat_id: int) -> str:
+    return f"group:{chat_id}"
+
+
+def topics_key(group_id: int) -> str:
+    return f"topics:{group_id}"
+
+
+def get_redis() -> aioredis.Redis:
+    """Получить клиент Redis (lazy initialization)."""
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(settings.REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+    return _redis
+
+
+def _l1_available() -> bool:
+    return time.monotonic() >= _l1_disabled_until
+
+
+def _l1_failed(message: str, error: RedisError):
+    """Отключить L1 на L1_BACKOFF секунд после ошибки Redis."""
+    global _l1_disabled_until
+    _l1_disabled_until = time.monotonic() + L1_BACKOFF
+    logger.warning("%s: %s (L1 отключён на %s с)", message, error, L1_BACKOFF)
+
+
+async def close_redis():
+    """Закрыть клиент Redis (при остановке приложения)."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+
+async def get_many(*keys: str) -> list[Optional[Any]]:
+    """Прочитать несколько ключей; промахи L0 добираются одним MGET."""
+    values = [_local.get(key) for key in keys]
+    missing = [key for key, value in zip(keys, values) if value is None]
+    if not missing or not _l1_available():
+        return values
+
+    try:
+        raw = await get_redis().mget(missing)
+    except RedisError as e:
+        _l1_failed("Redis недоступен, чтение из БД", e)
+        return values
+
+    found = {}
+    for key, item in zip(missing, raw):
+        if item is not None:
+            found[key] = _local[key] = orjson.loads(item)
+    return [found.get(key, value) for key, value in zip(keys, values)]
+
+
+async def get(key: str) -> Optional[Any]:
+    """Прочитать значение по ключу."""
+    return (await get_many(key))[0]
+
+
+async def set(key: str, value: Any):
+    """Записать значение в оба уровня кэша."""
+    _local[key] = value
+    if not _l1_available():
+        return
+    try:
+        await get_redis().set(key, orjson.dumps(value), ex=L1_TTL)
+    except RedisError as e:
+        _l1_failed("Redis недоступен, значение не закэшировано", e)
+
+
+async def delete(*keys: str):
+    """
+    Инвалидировать ключи после записи в БД.
+
+    L0 других процессов не очищается — там значение живёт не дольше L0_TTL.
+    """
+    for key in keys:
+        _local.pop(key, None)
+    # Инвалидация пробует Redis и при отключённом L1: она редкая (запись в БД),
+    # а пропуск оставил бы в Redis устаревшее значение на L1_TTL
+    try:
+        await get_redis().delete(*keys)
+    except RedisError as e:
+        _l1_failed("Redis недоступен, ключи не удалены", e)
@@ -1,29 +1,43 @@
 import logging
-from typing import Optional
-from sqlalchemy import select
+from typing import NamedTuple, Optional
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.db.models import User, Group, Topic
+from src.services import cache
 
 logger = logging.getLogger(__name__)
 
+
+class TopicRow(NamedTuple):
+    """Активная тема для горячего пути (из БД или кэша)."""
+    telegram_topic_id: int
+    title: str
+    description: Optional[str]
+    format_policy_text: Optional[str]
+
+
 async def get_or_create_user(session: AsyncSession, telegram_user_id: int) -> User:
-    """Получить или создать пользователя."""
-    result = await session.execute(
-        select(User).where(User.telegram_user_id == telegram_user_id)
+    """
+    Получить или создать пользователя.
+
+    Один атомарный UPSERT: параллельные сообщения нового пользователя
+    не приводят к двойной вставке.
+    """
+    stmt = (
+        pg_insert(User)
+        .values(telegram_user_id=telegram_user_id)
+        # Пустое обновление нужно, чтобы RETURNING вернул и существующую строку
+        .on_conflict_do_update(
+            index_elements=[User.telegram_user_id],
+            set_={"telegram_user_id": telegram_user_id}
+        )
+        .returning(User)
+        .execution_options(populate_existing=True)
     )
-    user = result.scalar_one_or_none()
-    
-    if not user:
-        user = User(telegram_user_id=telegram_user_id)
-        session.add(user)
-        # Commit обычно делается на уровне выше, но тут для гарантии ID можно сделать flush
-        # Однако, в оригинальном коде был commit. 
-        # Оставим flush для получения ID, коммит будет снаружи или здесь если это атомарная операция
-        await session.commit() 
-        await session.refresh(user)
-        logger.info(f"Создан новый пользователь: {telegram_user_id}")
-    
+    user = (await session.scalars(stmt)).one()
+    await session.commit()
     return user
 
 
@@ -34,33 +48,95 @@ async def get_or_create_group(
     title: str = "Без названия", 
     is_forum: bool = False
 ) -> Group:
-    """Получить или создать группу."""
-    result = await session.execute(
-        select(Group).where(Group.telegram_group_id == chat_id)
+    """
+    Получить или создать группу.
+
+    UPSERT по telegram_group_id: название и признак форума обновляются
+    в том же запросе, владелец существующей группы не меняется.
+    """
+    stmt = pg_insert(Group).values(
+        telegram_group_id=chat_id,
+        title=title,
+        topics_enabled=is_forum,
+        user_id=user_id
     )
-    group = result.scalar_one_or_none()
-    
-    if not group:
-        group = Group(
-            telegram_group_id=chat_id,
-            title=title,
-            topics_enabled=is_forum,
-            user_id=user_id
+    stmt = (
+        stmt.on_conflict_do_update(
+            index_elements=[Group.telegram_group_id],
+            set_={
+                "title": stmt.excluded.title,
+                "topics_enabled": stmt.excluded.topics_enabled
+            }
         )
-        session.add(group)
-        await session.commit()
-        await session.refresh(group)
-        logger.info(f"Создана новая группа: {title} ({chat_id})")
-    else:
-        # Обновляем инфо если нужно
-        if group.title != title or group.topics_enabled != is_forum:
-            group.title = title
-            group.topics_enabled = is_forum
-            await session.commit()
-    
+        .returning(Group)
+        .execution_options(populate_existing=True)
+    )
+    group = (await session.scalars(stmt)).one()
+    await session.commit()
+    await cache.delete(cache.group_key(chat_id))
     return group
 
 
+async def load_context(
+    session: AsyncSession,
+    telegram_user_id: int,
+    chat_id: int,
+    title: str = "Без названия",
+    is_forum: bool = False
+) -> tuple[User, Group, list[TopicRow]]:
+    """
+    Загрузить пользователя, группу и активные темы группы.
+
+    Сначала читается кэш; при промахе пользователь и группа читаются одним
+    запросом (LEFT JOIN), темы — кортежами через get_group_topic_rows.
+    UPSERT выполняется только если записей нет или данные группы изменились.
+    Из кэша возвращаются не привязанные к сессии User/Group — только колонки.
+    """
+    cached_user_id, cached_group = await cache.get_many(
+        cache.user_key(telegram_user_id), cache.group_key(chat_id)
+    )
+    if (
+        cached_user_id is not None and cached_group is not None
+        and cached_group["title"] == title and cached_group["topics_enabled"] == is_forum
+    ):
+        user = User(id=cached_user_id, telegram_user_id=telegram_user_id)
+        group = Group(**cached_group)
+    else:
+        result = await session.execute(
+            select(User, Group)
+            .outerjoin(Group, Group.telegram_group_id == chat_id)
+            .where(User.telegram_user_id == telegram_user_id)
+        )
+        row = result.first()
+        user, group = row if row else (None, None)
+
+        if user is None:
+            user = await get_or_create_user(session, telegram_user_id)
+
+        # Запись в БД — только если группы нет или её инфо изменилось
+        if group is None or group.title != title or group.topics_enabled != is_forum:
+            group = await get_or_create_group(session, user.id, chat_id, title, is_forum)
+
+        await cache.set(cache.user_key(telegram_user_id), user.id)
+        await cache.set(cache.group_key(chat_id), {
+            "id": group.id,
+            "telegram_group_id": group.telegram_group_id,
+            "title": group.title,
+            "topics_enabled": group.topics_enabled,
+            "user_id": group.user_id
+        })
+
+    cached_topics = await cache.get(cache.topics_key(group.id))
+    if cached_topics is not None:
+        topics = [TopicRow(*t) for t in cached_topics]
+    else:
+        topics = await get_group_topic_rows(session, group.id)
+        # orjson не сериализует подклассы tuple — в кэш кладутся списки
+        await cache.set(cache.topics_key(group.id), [list(t) for t in topics])
+
+    return user, group, topics
+
+
 async def get_user_group(session: AsyncSession, telegram_user_id: int) -> Optional[Group]:
     """Получить группу пользователя."""
     result = await session.execute(
@@ -88,15 +164,29 @@ async def create_topic(
     telegram_topic_id: int, 
     title: str = "Тема"
 ) -> Topic:
-    """Создать новую тему."""
-    topic = Topic(
-        telegram_topic_id=telegram_topic_id,
-        title=title,
-        group_id=group_id,
-        is_active=True
+    """
+    Создать новую тему.
+
+    Параллельные сообщения в новой теме могут создавать её одновременно:
+    при конфликте по (group_id, telegram_topic_id) возвращается существующая.
+    """
+    stmt = (
+        pg_insert(Topic)
+        .values(
+            telegram_topic_id=telegram_topic_id,
+            title=title,
+            group_id=group_id,
+            is_active=True
+        )
+        .on_conflict_do_nothing(index_elements=[Topic.group_id, Topic.telegram_topic_id])
+        .returning(Topic)
+        .execution_options(populate_existing=True)
     )
-    session.add(topic)
+    topic = (await session.scalars(stmt)).one_or_none()
     await session.commit()
+    if topic is None:
+        return await get_topic(session, group_id, telegram_topic_id)
+    await cache.delete(cache.topics_key(group_id))
     return topic
 
 
@@ -110,7 +200,7 @@ async def get_or_create_topic(
     topic = await get_topic(session, group_id, telegram_topic_id)
     if not topic:
         topic = await create_topic(session, group_id, telegram_topic_id, title)
-        logger.info(f"[DB] Создана тема {telegram_topic_id} в группе {group_id}")
+        logger.info("[DB] Создана тема %s в группе %s", telegram_topic_id, group_id)
     return topic
 
 async def get_group_topics(session: AsyncSession, group_id: int) -> list[Topic]:
@@ -124,6 +214,27 @@ async def get_group_topics(session: AsyncSession, group_id: int) -> list[Topic]:
     return list(result.scalars().all())
 
 
+async def get_group_topic_rows(session: AsyncSession, group_id: int) -> list[TopicRow]:
+    """
+    Получить активные темы группы кортежами (без ORM-объектов).
+
+    Для горячего пути обработки сообщений: только нужные колонки, без
+    identity map и загрузки связей. Для редактирования тем — get_group_topics.
+    """
+    result = await session.execute(
+        select(
+            Topic.telegram_topic_id,
+            Topic.title,
+            Topic.description,
+            Topic.format_policy_text
+        ).where(
+            Topic.group_id == group_id,
+            Topic.is_active == True
+        )
+    )
+    return [TopicRow(*row) for row in result.all()]
+
+
 async def create_confirmation(
     session: AsyncSession,
     user_id: int,
@@ -153,3 +264,24 @@ async def get_confirmation(session: AsyncSession, confirmation_id: int) -> Optio
         select(PendingConfirmation).where(PendingConfirmation.id == confirmation_id)
     )
     return result.scalar_one_or_none()
+
+
+# Ключ advisory-блокировки PostgreSQL для очистки подтверждений
+EXPIRE_CONFIRMATIONS_LOCK = 0x5EC2E7A1
+
+
+async def delete_expired_confirmations(session: AsyncSession) -> int:
+    """Удалить просроченные подтверждения одним запросом. Возвращает число удалённых."""
+    from src.db.models import PendingConfirmation
+    # Очистку запускает каждый процесс uvicorn; удаляет тот, кто взял блокировку,
+    # остальные пропускают проход (блокировка снимается при commit)
+    locked = await session.scalar(select(func.pg_try_advisory_xact_lock(EXPIRE_CONFIRMATIONS_LOCK)))
+    if not locked:
+        return 0
+    # expires_at хранится в UTC без часового пояса — сравниваем с now() в UTC
+    result = await session.execute(
+        delete(PendingConfirmation)
+        .where(PendingConfirmation.expires_at < func.timezone("utc", func.now()))
+    )
+    await session.commit()
+    return result.rowcount
@@ -4,18 +4,52 @@ Topic Sync Service
 Синхронизация тем из Telegram группы.
 """
 
+import asyncio
 import logging
 from typing import Optional
 from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import ForumTopic
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.db.database import get_async_session_maker
 from src.db.models import User, Group, Topic
+from src.services import cache, db_service
 
 logger = logging.getLogger(__name__)
 
+# Лимиты исходящих вызовов Bot API: общий на бота и на каждый чат
+_BOT_LIMITER = AsyncLimiter(30, 1)
+CHAT_LIMIT_PERIOD = 60
+# Лимитер чата живёт CHAT_LIMIT_PERIOD после последнего вызова: к этому моменту
+# окно уже пустое, и новый лимитер ведёт себя так же. Размер кэша ограничен
+_CHAT_LIMITERS: TTLCache = TTLCache(maxsize=4096, ttl=CHAT_LIMIT_PERIOD)
+
+
+def _chat_limiter(chat_id: int) -> AsyncLimiter:
+    limiter = _CHAT_LIMITERS.get(chat_id) or AsyncLimiter(20, CHAT_LIMIT_PERIOD)
+    # Повторная запись продлевает TTL
+    _CHAT_LIMITERS[chat_id] = limiter
+    return limiter
+
+
+async def _limited_get_chat(bot: Bot, chat_id: int):
+    """bot.get_chat с ограничением частоты и одним повтором после flood wait."""
+    async with _BOT_LIMITER, _chat_limiter(chat_id):
+        try:
+            return await bot.get_chat(chat_id)
+        except TelegramRetryAfter as e:
+            logger.warning("Flood wait %s с для get_chat(%s)", e.retry_after, chat_id)
+            retry_after = e.retry_after
+
+    await asyncio.sleep(retry_after)
+    async with _BOT_LIMITER, _chat_limiter(chat_id):
+        return await bot.get_chat(chat_id)
+
 
 async def get_forum_topics(bot: Bot, chat_id: int) -> list[dict]:
     """
@@ -57,18 +91,20 @@ async def sync_topics_from_messages(
     
     # Получаем информацию о группе
     try:
-        chat = await bot.get_chat(group.telegram_group_id)
+        chat = await _limited_get_chat(bot, group.telegram_group_id)
         
         # Проверяем что это форум
         if not getattr(chat, 'is_forum', False):
             group.topics_enabled = False
             await session.commit()
+            await cache.delete(cache.group_key(group.telegram_group_id))
             return {"status": "error", "message": "Группа не является форумом"}
         
         # Обновляем название группы если изменилось
         if chat.title != group.title:
             group.title = chat.title
             await session.commit()
+            await cache.delete(cache.group_key(group.telegram_group_id))
         
         return {
             "status": "ok",
@@ -78,7 +114,7 @@ async def sync_topics_from_messages(
         }
         
     except Exception as e:
-        logger.error(f"Ошибка при синхронизации: {e}")
+        logger.error("Ошибка при синхронизации: %s", e)
         return {"status": "error", "message": str(e)}
 
 
@@ -106,20 +142,13 @@ async def add_topic_if_not_exists(
         if topic.title != title:
             topic.title = title
             await session.commit()
+            await cache.delete(cache.topics_key(group_id))
         return topic
     
-    # Создаём новую тему
-    topic = Topic(
-        telegram_topic_id=telegram_topic_id,
-        title=title,
-        group_id=group_id,
-        is_active=True
-    )
-    session.add(topic)
-    await session.commit()
-    await session.refresh(topic)
+    # Создаём новую тему (при параллельном создании вернётся существующая)
+    topic = await db_service.create_topic(session, group_id, telegram_topic_id, title)
     
-    logger.info(f"Добавлена тема: {title} (id={telegram_topic_id})")
+    logger.info("Добавлена тема: %s (id=%s)", title, telegram_topic_id)
     return topic
 
 
@@ -138,17 +167,30 @@ async def create_default_topics(
         {"title": "🎯 Цели", "description": "Цели и планы на будущее"},
     ]
     
-    created_topics = []
-    for i, t in enumerate(default_topics):
-        topic = await add_topic_if_not_exists(
-            session, 
-            group_id, 
-            telegram_topic_id=i + 1,  # Фиктивные ID для демо
-            title=t["title"]
+    # Один UPSERT вместо SELECT/INSERT/commit на каждую тему
+    stmt = pg_insert(Topic).values([
+        {
+            "group_id": group_id,
+            "telegram_topic_id": i + 1,  # Фиктивные ID для демо
+            "title": t["title"],
+            "description": t["description"],
+            "is_active": True
+        }
+        for i, t in enumerate(default_topics)
+    ])
+    stmt = (
+        stmt.on_conflict_do_update(
+            index_elements=[Topic.group_id, Topic.telegram_topic_id],
+            set_={
+                "title": stmt.excluded.title,
+                "description": stmt.excluded.description
+            }
         )
-        if topic.description != t["description"]:
-            topic.description = t["description"]
-        created_topics.append(topic)
+        .returning(Topic)
+        .execution_options(populate_existing=True)
+    )
+    created_topics = list((await session.scalars(stmt)).all())
     
     await session.commit()
-    return created_topics
+    await cache.delete(cache.topics_key(group_id))
+    return sorted(created_topics, key=lambda t: t.telegram_topic_id)
@@ -44,11 +44,15 @@ class GoogleSTT(STTService):
         return ""
 
 
+_PROVIDERS: dict[str, type[STTService]] = {
+    "openai": OpenAISTT,
+    "google": GoogleSTT,
+}
+
+
 def get_stt_service(provider: str = "openai") -> STTService:
     """Factory function to get STT service by provider name."""
-    if provider == "openai":
-        return OpenAISTT()
-    elif provider == "google":
-        return GoogleSTT()
-    else:
+    cls = _PROVIDERS.get(provider)
+    if cls is None:
         raise ValueError(f"Unknown STT provider: {provider}")
+    return cls()
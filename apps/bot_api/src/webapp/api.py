@@ -8,18 +8,21 @@ import hashlib
 import hmac
 import json
 import logging
+from functools import lru_cache
 from urllib.parse import parse_qsl
 
 from fastapi import APIRouter, Depends, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
-from sqlalchemy import select
+from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import contains_eager, selectinload
 
-from src.db.database import get_async_session_maker
+from src.db.database import get_session
 from src.db.models import User, Group, Topic, AISettings
-from src.settings.config import settings
+from src.services import cache
+from src.settings.config import Settings, get_settings
 
 logger = logging.getLogger(__name__)
 
@@ -78,6 +81,51 @@ class GroupResponse(BaseModel):
 
 # ============ Auth Helpers ============
 
+@lru_cache(maxsize=4)
+def _webapp_secret(bot_token: str) -> bytes:
+    """secret_key проверки initData: зависит только от токена бота."""
+    return hmac.new(
+        b"WebAppData",
+        bot_token.encode(),
+        hashlib.sha256
+    ).digest()
+
+
+@lru_cache(maxsize=4096)
+def _validate(init_data: str, secret: bytes) -> tuple[tuple[str, str], ...] | None:
+    """
+    Проверить подпись initData. Возвращает пары ключ-значение без hash или None.
+
+    WebApp присылает одну и ту же строку initData во всех запросах сессии,
+    поэтому результат кэшируется; кортеж неизменяем — кэш нельзя испортить.
+    Секрет входит в ключ кэша: после смены токена (get_settings.cache_clear())
+    старые результаты не используются.
+    """
+    parsed = dict(parse_qsl(init_data, keep_blank_values=True))
+    
+    # Получаем hash из данных
+    received_hash = parsed.pop("hash", None)
+    if not received_hash:
+        return None
+    
+    # Сортируем оставшиеся параметры
+    data_check_string = "\n".join(
+        f"{k}={v}" for k, v in sorted(parsed.items())
+    )
+    
+    # Вычисляем hash
+    computed_hash = hmac.new(
+        secret,
+        data_check_string.encode(),
+        hashlib.sha256
+    ).hexdigest()
+    
+    if hmac.compare_digest(computed_hash, received_hash):
+        return tuple(parsed.items())
+    
+    return None
+
+
 def validate_telegram_init_data(init_data: str) -> dict | None:
     """
     Валидация Telegram WebApp initData.
@@ -87,58 +135,35 @@ def validate_telegram_init_data(init_data: str) -> dict | None:
         return None
     
     try:
-        parsed = dict(parse_qsl(init_data, keep_blank_values=True))
-        
-        # Получаем hash из данных
-        received_hash = parsed.pop("hash", None)
-        if not received_hash:
+        items = _validate(init_data, _webapp_secret(get_settings().TELEGRAM_BOT_TOKEN))
+        if items is None:
             return None
         
-        # Сортируем оставшиеся параметры
-        data_check_string = "\n".join(
-            f"{k}={v}" for k, v in sorted(parsed.items())
-        )
-        
-        # Вычисляем secret_key
-        secret_key = hmac.new(
-            b"WebAppData",
-            settings.TELEGRAM_BOT_TOKEN.encode(),
-            hashlib.sha256
-        ).digest()
-        
-        # Вычисляем hash
-        computed_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
-        
-        if computed_hash == received_hash:
-            # Парсим user
-            if "user" in parsed:
-                parsed["user"] = json.loads(parsed["user"])
-            return parsed
-        
-        return None
+        # Новый dict на каждый вызов
+        parsed = dict(items)
+        # Парсим user
+        if "user" in parsed:
+            parsed["user"] = json.loads(parsed["user"])
+        return parsed
     except Exception as e:
         logger.error(f"Ошибка валидации initData: {e}")
         return None
 
 
 async def get_current_user(
-    x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data")
+    x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data"),
+    session: AsyncSession = Depends(get_session),
+    app_settings: Settings = Depends(get_settings)
 ) -> User:
     """
     Получить текущего пользователя из Telegram initData.
     """
     # Для разработки: если нет initData, используем первого пользователя
-    if not x_telegram_init_data or settings.DEBUG:
-        session_maker = get_async_session_maker()
-        async with session_maker() as session:
-            result = await session.execute(select(User).limit(1))
-            user = result.scalar_one_or_none()
-            if user:
-                return user
+    if not x_telegram_init_data or app_settings.DEBUG:
+        result = await session.execute(select(User).limit(1))
+        user = result.scalar_one_or_none()
+        if user:
+            return user
     
     # Валидация initData
     data = validate_telegram_init_data(x_telegram_init_data)
@@ -147,246 +172,224 @@ async def get_current_user(
     
     telegram_user_id = data["user"]["id"]
     
+    # Тот же ключ кэша, что и у бота: telegram_user_id -> users.id.
+    # Эндпоинтам нужен только id, поэтому возвращается User без сессии
+    user_id = await cache.get(cache.user_key(telegram_user_id))
+    if user_id is not None:
+        return User(id=user_id, telegram_user_id=telegram_user_id)
+    
     # Получаем пользователя из БД
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_user_id == telegram_user_id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        return user
+    result = await session.execute(
+        select(User).where(User.telegram_user_id == telegram_user_id)
+    )
+    user = result.scalar_one_or_none()
+    
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    await cache.set(cache.user_key(telegram_user_id), user.id)
+    return user
 
 
 # ============ Group ============
 
 @router.get("/group", response_model=Optional[GroupResponse])
-async def get_group(user: User = Depends(get_current_user)):
+async def get_group(
+    user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
+):
     """Получить группу пользователя."""
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        result = await session.execute(
-            select(Group).where(Group.user_id == user.id)
-        )
-        group = result.scalar_one_or_none()
-        
-        if not group:
-            return None
-        
-        return GroupResponse(
-            id=group.id,
-            title=group.title,
-            telegram_group_id=group.telegram_group_id,
-            topics_enabled=group.topics_enabled
-        )
+    result = await session.execute(
+        select(Group).where(Group.user_id == user.id)
+    )
+    group = result.scalar_one_or_none()
+    
+    if not group:
+        return None
+    
+    return group
 
 
 # ============ Topics ============
 
 @router.get("/topics", response_model=list[TopicResponse])
-async def list_topics(user: User = Depends(get_current_user)):
+async def list_topics(
+    user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
+):
     """Получить все темы группы пользователя."""
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        # Получаем группу пользователя
-        group_result = await session.execute(
-            select(Group).where(Group.user_id == user.id)
-        )
-        group = group_result.scalar_one_or_none()
-        
-        if not group:
-            return []
-        
-        # Получаем темы
-        topics_result = await session.execute(
-            select(Topic).where(Topic.group_id == group.id)
-        )
-        topics = topics_result.scalars().all()
-        
-        return [
-            TopicResponse(
-                id=t.id,
-                telegram_topic_id=t.telegram_topic_id,
-                title=t.title,
-                description=t.description,
-                format_policy_text=t.format_policy_text,
-                is_active=t.is_active
-            )
-            for t in topics
-        ]
+    # Группа пользователя вместе с темами (selectinload — один запрос IN для тем)
+    group_result = await session.execute(
+        select(Group)
+        .options(selectinload(Group.topics))
+        .where(Group.user_id == user.id)
+    )
+    group = group_result.scalar_one_or_none()
+    
+    if not group:
+        return []
+    
+    # Конвертацию в TopicResponse выполняет response_model (from_attributes)
+    return group.topics
 
 
 @router.get("/topics/{topic_id}", response_model=TopicResponse)
-async def get_topic(topic_id: int, user: User = Depends(get_current_user)):
+async def get_topic(
+    topic_id: int,
+    user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
+):
     """Получить конкретную тему по ID."""
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        # Проверяем, что тема принадлежит пользователю
-        result = await session.execute(
-            select(Topic)
-            .join(Group)
-            .where(Topic.id == topic_id, Group.user_id == user.id)
-        )
-        topic = result.scalar_one_or_none()
-        
-        if not topic:
-            raise HTTPException(status_code=404, detail="Topic not found")
-        
-        return TopicResponse(
-            id=topic.id,
-            telegram_topic_id=topic.telegram_topic_id,
-            title=topic.title,
-            description=topic.description,
-            format_policy_text=topic.format_policy_text,
-            is_active=topic.is_active
-        )
+    # Проверяем, что тема принадлежит пользователю
+    # Группа берётся из того же JOIN (contains_eager) — topic.group без доп. запроса
+    result = await session.execute(
+        select(Topic)
+        .join(Topic.group)
+        .options(contains_eager(Topic.group))
+        .where(Topic.id == topic_id, Group.user_id == user.id)
+    )
+    topic = result.scalar_one_or_none()
+    
+    if not topic:
+        raise HTTPException(status_code=404, detail="Topic not found")
+    
+    return topic
 
 
 @router.patch("/topics/{topic_id}", response_model=TopicResponse)
 async def update_topic(
     topic_id: int, 
     topic_update: TopicUpdate,
-    user: User = Depends(get_current_user)
+    user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
 ):
     """Обновить описание или правила форматирования темы."""
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        # Проверяем, что тема принадлежит пользователю
-        result = await session.execute(
-            select(Topic)
-            .join(Group)
-            .where(Topic.id == topic_id, Group.user_id == user.id)
-        )
-        topic = result.scalar_one_or_none()
-        
-        if not topic:
-            raise HTTPException(status_code=404, detail="Topic not found")
-        
-        # Обновляем поля
-        if topic_update.description is not None:
-            topic.description = topic_update.description
-        if topic_update.format_policy_text is not None:
-            topic.format_policy_text = topic_update.format_policy_text
-        
+    # Проверяем, что тема принадлежит пользователю
+    # Группа берётся из того же JOIN (contains_eager) — topic.group без доп. запроса
+    result = await session.execute(
+        select(Topic)
+        .join(Topic.group)
+        .options(contains_eager(Topic.group))
+        .where(Topic.id == topic_id, Group.user_id == user.id)
+    )
+    topic = result.scalar_one_or_none()
+    
+    if not topic:
+        raise HTTPException(status_code=404, detail="Topic not found")
+    
+    # Обновляем только изменившиеся поля
+    changed = False
+    if topic_update.description is not None and topic.description != topic_update.description:
+        topic.description = topic_update.description
+        changed = True
+    if topic_update.format_policy_text is not None and topic.format_policy_text != topic_update.format_policy_text:
+        topic.format_policy_text = topic_update.format_policy_text
+        changed = True
+    
+    # Без изменений — ни commit, ни инвалидации кэша. refresh не нужен:
+    # значения уже в объекте (expire_on_commit=False)
+    if changed:
         await session.commit()
-        await session.refresh(topic)
-        
-        return TopicResponse(
-            id=topic.id,
-            telegram_topic_id=topic.telegram_topic_id,
-            title=topic.title,
-            description=topic.description,
-            format_policy_text=topic.format_policy_text,
-            is_active=topic.is_active
-        )
+        await cache.delete(cache.topics_key(topic.group_id))
+    
+    return topic
 
 
 @router.post("/topics/sync")
-async def sync_topics(user: User = Depends(get_current_user)):
+async def sync_topics(
+    user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
+):
     """
     Синхронизировать темы из Telegram группы.
     
     Темы добавляются автоматически когда бот видит сообщения в группе.
     Нажмите кнопку синхронизации после отправки сообщений в темы.
     """
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        # Получаем группу пользователя
-        result = await session.execute(
-            select(Group).where(Group.user_id == user.id)
-        )
-        group = result.scalar_one_or_none()
-        
-        if not group:
-            raise HTTPException(status_code=404, detail="Группа не найдена. Добавьте бота в группу.")
-        
-        # Получаем темы
-        topics_result = await session.execute(
-            select(Topic).where(Topic.group_id == group.id)
-        )
-        existing_topics = topics_result.scalars().all()
-        
-        if existing_topics:
-            return {
-                "status": "ok",
-                "message": f"Найдено {len(existing_topics)} тем",
-                "synced_count": len(existing_topics)
-            }
-        
-        # Если тем нет — инструктируем пользователя
+    # Группа и число её тем одним запросом: сами темы здесь не нужны
+    result = await session.execute(
+        select(Group.id, func.count(Topic.id))
+        .outerjoin(Group.topics)
+        .where(Group.user_id == user.id)
+        .group_by(Group.id)
+    )
+    row = result.one_or_none()
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="Группа не найдена. Добавьте бота в группу.")
+    
+    _, topics_count = row
+    
+    if topics_count:
         return {
-            "status": "info",
-            "message": "Тем пока нет. Отправьте сообщение в любую тему вашей группы — бот автоматически добавит её.",
-            "synced_count": 0
+            "status": "ok",
+            "message": f"Найдено {topics_count} тем",
+            "synced_count": topics_count
         }
+    
+    # Если тем нет — инструктируем пользователя
+    return {
+        "status": "info",
+        "message": "Тем пока нет. Отправьте сообщение в любую тему вашей группы — бот автоматически добавит её.",
+        "synced_count": 0
+    }
 
 
 # ============ AI Settings ============
 
 @router.get("/settings/ai", response_model=AISettingsResponse)
-async def get_ai_settings(user: User = Depends(get_current_user)):
+async def get_ai_settings(
+    user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
+):
     """Получить настройки AI пользователя."""
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        result = await session.execute(
-            select(AISettings).where(AISettings.user_id == user.id)
-        )
-        ai_settings = result.scalar_one_or_none()
-        
-        if not ai_settings:
-            # Возвращаем дефолтные настройки
-            return AISettingsResponse(
-                provider="gemini",
-                model="gemini-pro",
-                brevity_level=3
-            )
-        
+    result = await session.execute(
+        select(AISettings).where(AISettings.user_id == user.id)
+    )
+    ai_settings = result.scalar_one_or_none()
+    
+    if not ai_settings:
+        # Возвращаем дефолтные настройки
         return AISettingsResponse(
-            provider=ai_settings.provider,
-            model=ai_settings.model,
-            brevity_level=ai_settings.brevity_level
+            provider="gemini",
+            model="gemini-pro",
+            brevity_level=3
         )
+    
+    return ai_settings
 
 
 @router.patch("/settings/ai", response_model=AISettingsResponse)
 async def update_ai_settings(
     settings_update: AISettingsUpdate,
-    user: User = Depends(get_current_user)
+    user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session)
 ):
     """Обновить настройки AI."""
-    session_maker = get_async_session_maker()
-    async with session_maker() as session:
-        result = await session.execute(
-            select(AISettings).where(AISettings.user_id == user.id)
-        )
-        ai_settings = result.scalar_one_or_none()
-        
-        if not ai_settings:
-            # Создаём новые настройки
-            ai_settings = AISettings(
-                user_id=user.id,
-                provider=settings_update.provider or "gemini",
-                model=settings_update.model or "gemini-pro",
-                brevity_level=settings_update.brevity_level or 3
-            )
-            session.add(ai_settings)
-        else:
-            # Обновляем существующие
-            if settings_update.provider is not None:
-                ai_settings.provider = settings_update.provider
-            if settings_update.model is not None:
-                ai_settings.model = settings_update.model
-            if settings_update.brevity_level is not None:
-                ai_settings.brevity_level = settings_update.brevity_level
-        
-        await session.commit()
-        await session.refresh(ai_settings)
-        
-        return AISettingsResponse(
-            provider=ai_settings.provider,
-            model=ai_settings.model,
-            brevity_level=ai_settings.brevity_level
+    result = await session.execute(
+        select(AISettings).where(AISettings.user_id == user.id)
+    )
+    ai_settings = result.scalar_one_or_none()
+    
+    if not ai_settings:
+        # Создаём новые настройки
+        ai_settings = AISettings(
+            user_id=user.id,
+            provider=settings_update.provider or "gemini",
+            model=settings_update.model or "gemini-pro",
+            brevity_level=settings_update.brevity_level or 3
         )
+        session.add(ai_settings)
+    else:
+        # Обновляем существующие
+        if settings_update.provider is not None:
+            ai_settings.provider = settings_update.provider
+        if settings_update.model is not None:
+            ai_settings.model = settings_update.model
+        if settings_update.brevity_level is not None:
+            ai_settings.brevity_level = settings_update.brevity_level
+    
+    # Поля ответа заданы в Python и после commit не сбрасываются (expire_on_commit=False)
+    await session.commit()
+    
+    return ai_settings
@@ -4,6 +4,9 @@ Worker Configuration
 Настройки воркера через pydantic-settings.
 """
 
+from functools import lru_cache
+from typing import Final
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -13,7 +16,9 @@ class WorkerSettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
-        extra="ignore"
+        extra="ignore",
+        # Настройки читаются один раз при старте и не меняются
+        frozen=True
     )
 
     # Redis
@@ -30,8 +35,29 @@ class WorkerSettings(BaseSettings):
     GEMINI_API_KEY: str | None = None
 
     # Worker settings
-    WORKER_CONCURRENCY: int = 2
+    # Пул gevent: задачи почти всё время ждут HTTP (Telegram, OpenAI, Gemini),
+    # десятки greenlet'ов в одном процессе вместо пары prefork-процессов
+    WORKER_POOL: str = "gevent"
+    WORKER_CONCURRENCY: int = 50
+    # Задачи сетевые (STT, загрузка ссылок и файлов): одно лишнее сообщение
+    # на процесс убирает простой на RTT брокера. Для CPU-задач — 4,
+    # для задач с длинным ETA/countdown — 1
+    WORKER_PREFETCH_MULTIPLIER: int = 2
+    # Очередь metadata: короткие идемпотентные задачи, большое окно prefetch
+    # и ack при получении — без отдельного RTT брокера на каждое сообщение
+    METADATA_PREFETCH_MULTIPLIER: int = 32
     LOG_LEVEL: str = "INFO"
 
 
-settings = WorkerSettings()
+@lru_cache
+def get_settings() -> WorkerSettings:
+    """Экземпляр настроек воркера (создаётся один раз)."""
+    return WorkerSettings()
+
+
+settings = get_settings()
+
+# Значения для задач: обычные атрибуты модуля без обращения к модели
+REDIS_URL: Final[str] = settings.REDIS_URL
+TELEGRAM_BOT_TOKEN: Final[str] = settings.TELEGRAM_BOT_TOKEN
+OPENAI_API_KEY: Final[str | None] = settings.OPENAI_API_KEY
@@ -4,15 +4,200 @@ Celery Tasks
 Фоновые задачи для обработки данных.
 """
 
+import hashlib
 import logging
+import tempfile
 from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
 
+import httpx
+import msgpack
+import orjson
+import redis
+from selectolax.lexbor import LexborHTMLParser
+
+from .config import OPENAI_API_KEY, REDIS_URL, TELEGRAM_BOT_TOKEN
 from .worker import celery_app
 
 logger = logging.getLogger(__name__)
 
+TELEGRAM_API_URL = "https://api.telegram.org"
+OPENAI_API_URL = "https://api.openai.com/v1"
+
+# Для метаданных достаточно начала страницы (<head>)
+METADATA_RANGE_BYTES = 32768
+
+# Файлы Telegram качаются потоком: до SPOOL_MAX_SIZE в памяти, дальше — на диск
+DOWNLOAD_CHUNK_SIZE = 65536
+SPOOL_MAX_SIZE = 1 << 20
+# Сколько текста извлекать из текстовых файлов
+MAX_EXTRACTED_TEXT = 65536
+
+# Путь файла из getFile действителен около часа
+FILE_PATH_TTL = 3300
+# Метаданные ссылок меняются редко
+URL_METADATA_TTL = 86400
+
+_http_client: Optional[httpx.Client] = None
+_redis: Optional[redis.Redis] = None
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Общий HTTP-клиент процесса воркера (создаётся лениво).
+
+    Keep-alive соединения и TLS-сессии переиспользуются между задачами.
+    Под пулом gevent сокеты кооперативные, поэтому синхронный клиент
+    не блокирует соседние задачи.
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(
+            http2=True,
+            timeout=60,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+    return _http_client
+
+
+def get_redis() -> redis.Redis:
+    """Клиент Redis для кэшей воркера (создаётся лениво)."""
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(
+            REDIS_URL,
+            socket_timeout=1,
+            socket_connect_timeout=1
+        )
+    return _redis
+
+
+def _cache_get(key: str) -> Optional[bytes]:
+    """Прочитать значение кэша; недоступность Redis — промах."""
+    try:
+        return get_redis().get(key)
+    except redis.RedisError as e:
+        logger.warning("Redis недоступен: %s", e)
+        return None
+
+
+def _cache_set(key: str, ttl: int, value: bytes | str) -> None:
+    """Записать значение кэша с TTL; ошибки Redis не прерывают задачу."""
+    try:
+        get_redis().setex(key, ttl, value)
+    except redis.RedisError as e:
+        logger.warning("Redis недоступен: %s", e)
+
+
+def _get_file_path(file_id: str) -> str:
+    """
+    Путь файла Telegram по file_id.
+
+    Кэшируется в Redis: повторы задачи и другие процессы воркера
+    не делают лишний getFile. Недоступность Redis не мешает скачиванию.
+    """
+    key = f"tg:path:{file_id}"
+    cached = _cache_get(key)
+    if cached:
+        return cached.decode()
+
+    response = get_http_client().get(
+        f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/getFile",
+        params={"file_id": file_id}
+    )
+    response.raise_for_status()
+    file_path = orjson.loads(response.content)["result"]["file_path"]
+
+    _cache_set(key, FILE_PATH_TTL, file_path)
+    return file_path
+
+
+def _telegram_file_url(file_id: str) -> str:
+    """Получить URL скачивания файла Telegram по file_id."""
+    return f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_BOT_TOKEN}/{_get_file_path(file_id)}"
 
-@celery_app.task(bind=True, max_retries=3, default_retry_delay=60)
+
+def _download_telegram_file(file_id: str) -> tempfile.SpooledTemporaryFile:
+    """
+    Скачать файл Telegram потоком во временный файл.
+
+    Память на задачу ограничена SPOOL_MAX_SIZE независимо от размера файла.
+    Возвращает файл, перемотанный в начало; закрывает вызывающий.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        with get_http_client().stream("GET", _telegram_file_url(file_id)) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def _read_telegram_file_head(file_id: str, limit: int) -> bytes:
+    """Прочитать первые limit байт файла Telegram; остаток не скачивается."""
+    buffer = bytearray()
+    with get_http_client().stream("GET", _telegram_file_url(file_id)) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) >= limit:
+                break
+    return bytes(buffer[:limit])
+
+
+def _url_metadata_key(url: str) -> str:
+    """Ключ кэша метаданных: хэш URL без фрагмента, со схемой и хостом в нижнем регистре."""
+    parts = urlsplit(url.strip())
+    canonical = urlunsplit((
+        parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""
+    ))
+    return "url:meta:" + hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def _fetch_url_metadata(url: str) -> dict:
+    """Загрузить начало страницы и извлечь title и meta description."""
+    client = get_http_client()
+    empty = {"url": url, "title": "", "description": "", "success": True}
+    
+    # HEAD отсекает PDF, картинки и прочее не-HTML без скачивания тела.
+    # Часть серверов HEAD не поддерживает — тогда сразу идём в GET
+    head = client.head(url)
+    content_type = head.headers.get("content-type", "")
+    if head.is_success and content_type and "text/html" not in content_type:
+        return empty
+    
+    # Range: сервер отдаёт только начало страницы, если поддерживает
+    # частичные ответы; иначе читаем поток до </head> и закрываем
+    buffer = bytearray()
+    with client.stream(
+        "GET", url, headers={"Range": f"bytes=0-{METADATA_RANGE_BYTES - 1}"}
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes():
+            buffer += chunk
+            if b"</head>" in buffer or len(buffer) >= METADATA_RANGE_BYTES:
+                break
+    
+    tree = LexborHTMLParser(bytes(buffer[:METADATA_RANGE_BYTES]))
+    title_node = tree.css_first("title")
+    meta_node = tree.css_first('meta[name="description"]')
+    title = title_node.text(strip=True) if title_node else ""
+    description = (meta_node.attributes.get("content") or "").strip() if meta_node else ""
+    
+    return {
+        "url": url,
+        "title": title,
+        "description": description,
+        "success": True
+    }
+
+
+@celery_app.task(bind=True, ignore_result=False, max_retries=3, default_retry_delay=60)
 def transcribe_voice(self, audio_file_id: str, user_id: int) -> dict:
     """
     Transcribe voice message using STT.
@@ -25,21 +210,31 @@ def transcribe_voice(self, audio_file_id: str, user_id: int) -> dict:
         dict with transcribed text
     """
     try:
-        logger.info(f"Transcribing voice message {audio_file_id} for user {user_id}")
+        logger.info("Transcribing voice message %s for user %s", audio_file_id, user_id)
         
-        # TODO: Implement STT
-        # 1. Download file from Telegram
-        # 2. Convert to appropriate format
-        # 3. Send to STT provider
-        # 4. Return result
+        if not OPENAI_API_KEY:
+            logger.warning("OPENAI_API_KEY не задан, распознавание недоступно")
+            return {"text": "", "success": False}
         
-        return {"text": "", "success": True}
+        # Whisper принимает OGG/OPUS из Telegram без конвертации через ffmpeg;
+        # multipart читает временный файл частями, а не целиком в память
+        with _download_telegram_file(audio_file_id) as audio:
+            response = get_http_client().post(
+                f"{OPENAI_API_URL}/audio/transcriptions",
+                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                files={"file": ("voice.ogg", audio, "audio/ogg")},
+                data={"model": "whisper-1", "language": "ru"}
+            )
+        response.raise_for_status()
+        
+        return {"text": orjson.loads(response.content).get("text", ""), "success": True}
     except Exception as exc:
-        logger.error(f"STT failed: {exc}")
+        logger.error("STT failed: %s", exc)
         raise self.retry(exc=exc)
 
 
-@celery_app.task(bind=True, max_retries=3, default_retry_delay=30)
+# Задача короткая и идемпотентная: ack при получении, повтор при потере не нужен
+@celery_app.task(bind=True, ignore_result=False, max_retries=3, default_retry_delay=30, acks_late=False)
 def fetch_url_metadata(self, url: str) -> dict:
     """
     Fetch title and description from URL.
@@ -51,25 +246,23 @@ def fetch_url_metadata(self, url: str) -> dict:
         dict with title, description, and URL
     """
     try:
-        logger.info(f"Fetching metadata for URL: {url}")
+        logger.info("Fetching metadata for URL: %s", url)
         
-        # TODO: Implement HTTP fetch
-        # 1. Make HEAD/GET request
-        # 2. Parse <title> and <meta name="description">
-        # 3. Return metadata
+        # Популярные ссылки присылают многие пользователи — отвечаем из кэша
+        key = _url_metadata_key(url)
+        cached = _cache_get(key)
+        if cached:
+            return {**msgpack.unpackb(cached), "url": url}
         
-        return {
-            "url": url,
-            "title": "",
-            "description": "",
-            "success": True
-        }
+        result = _fetch_url_metadata(url)
+        _cache_set(key, URL_METADATA_TTL, msgpack.packb(result))
+        return result
     except Exception as exc:
-        logger.error(f"URL fetch failed: {exc}")
+        logger.error("URL fetch failed: %s", exc)
         raise self.retry(exc=exc)
 
 
-@celery_app.task(bind=True, max_retries=2, default_retry_delay=60)
+@celery_app.task(bind=True, ignore_result=False, max_retries=2, default_retry_delay=60)
 def process_file(self, file_id: str, file_name: str, file_type: str, user_id: int) -> dict:
     """
     Process uploaded file.
@@ -84,31 +277,20 @@ def process_file(self, file_id: str, file_name: str, file_type: str, user_id: in
         dict with extracted metadata
     """
     try:
-        logger.info(f"Processing file {file_name} ({file_type}) for user {user_id}")
+        logger.info("Processing file %s (%s) for user %s", file_name, file_type, user_id)
         
-        # TODO: Implement file processing
-        # 1. Download file from Telegram
-        # 2. Extract text (if possible)
-        # 3. Return metadata
+        # Текст извлекается только из текстовых файлов: остальные не скачиваются
+        extracted_text = ""
+        if file_type.startswith("text/"):
+            head = _read_telegram_file_head(file_id, MAX_EXTRACTED_TEXT)
+            extracted_text = head.decode("utf-8", errors="replace")
         
         return {
             "file_name": file_name,
             "file_type": file_type,
-            "extracted_text": "",
+            "extracted_text": extracted_text,
             "success": True
         }
     except Exception as exc:
-        logger.error(f"File processing failed: {exc}")
+        logger.error("File processing failed: %s", exc)
         raise self.retry(exc=exc)
-
-
-@celery_app.task
-def cleanup_expired_confirmations():
-    """
-    Periodic task to clean up expired pending confirmations.
-    
-    Runs every hour.
-    """
-    logger.info("Cleaning up expired confirmations")
-    # TODO: Implement database cleanup
-    return {"deleted_count": 0}
@@ -4,10 +4,18 @@ Celery Worker Configuration
 Фоновые задачи: STT, обработка ссылок, файлов.
 """
 
+import logging
+
 from celery import Celery
 
 from .config import settings
 
+# Формат логов celery не использует thread/threadName и pid — не тратим
+# время на их получение для каждой записи. processName остаётся: он есть
+# в worker_log_format
+logging.logThreads = False
+logging.logProcesses = False
+
 # Create Celery app
 celery_app = Celery(
     "sekretar_worker",
@@ -18,20 +26,51 @@ celery_app = Celery(
 
 # Celery configuration
 celery_app.conf.update(
-    task_serializer="json",
-    accept_content=["json"],
-    result_serializer="json",
+    # msgpack: бинарный формат, быстрее JSON и компактнее в Redis.
+    # json остаётся в accept_content на время выкатки (старые сообщения в очереди)
+    task_serializer="msgpack",
+    accept_content=["msgpack", "json"],
+    result_serializer="msgpack",
+    # zstd: извлечённый текст файлов занимает сотни КБ, сжатие сокращает
+    # трафик до брокера и память Redis (компрессор kombu из пакета zstandard)
+    task_compression="zstd",
+    result_compression="zstd",
     timezone="Europe/Moscow",
     enable_utc=True,
     task_track_started=True,
     task_time_limit=300,  # 5 minutes max
     task_soft_time_limit=240,  # 4 minutes soft limit
-    worker_prefetch_multiplier=1,
+    worker_pool=settings.WORKER_POOL,
+    worker_concurrency=settings.WORKER_CONCURRENCY,
+    worker_prefetch_multiplier=settings.WORKER_PREFETCH_MULTIPLIER,
+    # Перезапуск дочерних процессов ограничивает рост RSS от фрагментации
+    # кучи в C-расширениях. Действует только при WORKER_POOL=prefork: у пула
+    # gevent (по умолчанию) дочерних процессов нет, лимиты игнорируются
+    worker_max_tasks_per_child=200,
+    worker_max_memory_per_child=512_000,  # KB
     task_acks_late=True,
     task_reject_on_worker_lost=True,
+    # Подзадачи получают приоритет родительской задачи
+    task_inherit_parent_priority=True,
+    # Результат сохраняется только у задач с ignore_result=False
+    task_ignore_result=True,
+    # Результаты читаются один раз — держим их час, а не сутки по умолчанию
+    result_expires=3600,
+    result_backend_transport_options={"global_keyprefix": "res:", "retry_on_timeout": True},
+    # Долгоживущие соединения с Redis: keepalive и проверка раз в 30 с,
+    # чтобы оборванное соединение обнаруживалось до очередного BRPOP
+    broker_transport_options={"socket_keepalive": True, "health_check_interval": 30},
+    redis_socket_keepalive=True,
 )
 
 # Dead letter queue for failed tasks
+# Сетевые задачи — в очередь io (gevent-воркер), остальное — в default.
+# Метаданные ссылок — в metadata: её слушает отдельный воркер с
+# --prefetch-multiplier=METADATA_PREFETCH_MULTIPLIER.
+# Для будущих CPU-задач поднимается отдельный prefork-воркер: -P prefork -Q default
 celery_app.conf.task_routes = {
+    "src.tasks.transcribe_voice": {"queue": "io"},
+    "src.tasks.fetch_url_metadata": {"queue": "metadata"},
+    "src.tasks.process_file": {"queue": "io"},
     "src.tasks.*": {"queue": "default"},
 }